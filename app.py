@@ -1,30 +1,649 @@
 import os
 from flask import (
     Flask,
+    Response,
     request,
-    jsonify,
+    jsonify as flask_jsonify,
     abort,
+    current_app,
     render_template,
     redirect,
+    stream_with_context,
     url_for
 )
-from sqlalchemy import exc
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 import json
 from flask_cors import CORS
 from datetime import date
 import time
 
-from models import setup_db, Actor, Movie, db_drop_and_create_all
-from auth import AuthError, requires_auth
+from models import (
+    setup_db,
+    db,
+    Actor,
+    Movie,
+    Gender,
+    TableVersion,
+    Stats,
+    casting,
+    format_value,
+    db_drop_and_create_all,
+    BULK_CHUNK_SIZE
+)
+from auth import AuthError, requires_auth, check_permissions
+from cache import cached_response, conditional_response
+from search import search, MAX_QUERY_LENGTH
+import changes
+import compression
+import metrics
+import querywatch
+import ratelimit
+from querywatch import query_budget
+from ratelimit import RateLimitError
+from replicas import get_replica_set, read_replica
+from serializer import get_serializer
 
 # uncomment the following line to reset the database upon flask run
 # db_drop_and_create_all()
 
+# create_app() logs a warning if it takes longer than this
+STARTUP_TARGET_SECONDS = float(os.environ.get('STARTUP_TARGET_SECONDS', 0.5))
+
+# if set, GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+ITEMS_PER_PAGE = 100
+MAX_ITEMS_PER_PAGE = 1000
+# ranked search results are paginated by offset, up to this offset
+MAX_SEARCH_OFFSET = 10000
+STREAM_BATCH_SIZE = 1000
+MAX_BULK_ITEMS = 10000
+# bulk routes run a few statements per chunk of BULK_CHUNK_SIZE items
+BULK_CHUNKS = -(-MAX_BULK_ITEMS // BULK_CHUNK_SIZE)
+BULK_QUERY_BUDGET = 4 * BULK_CHUNKS + 10
+MAX_AGE = 150
+# the range of the Integer id columns
+MAX_ID = 2 ** 31 - 1
+
+
+'''
+get_page_args()
+    reads the keyset pagination arguments "limit" and "after" from the request
+'''
+
+
+def get_page_args():
+    try:
+        limit = int(request.args.get('limit', ITEMS_PER_PAGE))
+        after = request.args.get('after')
+        after = int(after) if after is not None else None
+    except ValueError:
+        abort(400)
+    if limit < 1 or limit > MAX_ITEMS_PER_PAGE:
+        abort(400)
+    return limit, after
+
+
+'''
+get_fields(model)
+    reads the "fields" projection argument from the request
+    returns the fields (always including the id) in the model's order, so
+    every projection has one compiled row format, or None if all fields
+    were requested; unknown or repeated fields abort with 400
+'''
+
+
+def get_fields(model):
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = [field.strip() for field in fields.split(',')]
+    if any(field not in model.FIELDS for field in fields) or \
+            len(set(fields)) < len(fields):
+        abort(400)
+    requested = set(fields) | {'id'}
+    return [field for field in model.FIELDS if field in requested]
+
+
+'''
+get_include(relationship)
+    reads the "include" argument, which may name the given relationship
+    returns None if it was not given
+'''
+
+
+def get_include(relationship):
+    include = request.args.get('include')
+    if include is not None and include != relationship:
+        abort(400)
+    return include
+
+
+'''
+paginate(model, filters, limit, after, fields, include)
+    selects one page of rows ordered by id, starting after the id "after"
+    if include names a relationship, the related items of the whole page
+    are loaded with one more query and added to every item
+    returns the formatted rows and the cursor of the next page (or None)
+    without include, the fields are selected as plain column tuples (see
+    ReadMixin in models.py)
+'''
+
+
+def paginate(model, filters, limit, after, fields=None, include=None):
+    if include:
+        query = model.query.options(selectinload(getattr(model, include)))
+        query = query.filter(*filters)
+        if after is not None:
+            query = query.filter(model.id > after)
+        rows = query.order_by(model.id).limit(limit + 1).all()
+        items = [format_included(row, fields, include) for row in rows]
+    else:
+        statement, format_row = model.select_rows(
+            fields or model.FIELDS, filters, after, limit + 1)
+        items = [format_row(row) for row in db.session.execute(statement)]
+    next_after = items[limit - 1]['id'] if len(items) > limit else None
+    return items[:limit], next_after
+
+
+def format_included(row, fields, include):
+    if fields:
+        item = {field: format_value(getattr(row, field)) for field in fields}
+    else:
+        item = row.format()
+    item[include] = [related.format() for related in getattr(row, include)]
+    return item
+
+
+'''
+collection_version(resource)
+    the version of a collection response: the resource's version, plus the
+    version of the other resource if the response includes its items
+'''
+
+
+def collection_version(resource):
+    version = TableVersion.current(resource)
+    if request.args.get('include'):
+        other = Movie if resource == Actor.__tablename__ else Actor
+        version = f'{version}.{TableVersion.current(other.__tablename__)}'
+    return version
+
+
+'''
+paginate_cast(model, item_id, related)
+    one page of the "related" items cast with the "model" item item_id,
+    i.e. a movie's actors or an actor's movies
+'''
+
+
+def paginate_cast(model, item_id, related):
+    if model.query.get(item_id) is None:
+        abort(404)
+    limit, after = get_page_args()
+    fields = get_fields(related)
+    related_ids = select([casting.c[related.CASTING_KEY]]) \
+        .where(casting.c[model.CASTING_KEY] == item_id)
+    return paginate(related, [related.id.in_(related_ids)], limit, after,
+                    fields)
+
+
+'''
+search_page(model)
+    one page of the items matching the search query "q", best matches first
+    reads "q", "limit", "offset" and "fields" from the request
+    returns the formatted items and the offset of the next page (or None)
+'''
+
+
+def search_page(model):
+    q = request.args.get('q', '').strip()
+    try:
+        limit = int(request.args.get('limit', ITEMS_PER_PAGE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        abort(400)
+    if not q or len(q) > MAX_QUERY_LENGTH or limit < 1 or \
+            limit > MAX_ITEMS_PER_PAGE or not 0 <= offset <= MAX_SEARCH_OFFSET:
+        abort(400)
+    columns, format_row = model.row_format(
+        get_fields(model) or model.FIELDS)
+    rows = search(model, q, columns, limit + 1, offset)
+    next_offset = offset + limit if len(rows) > limit else None
+    items = [format_row(row) for row in rows[:limit]]
+    return items, next_offset
+
+
+'''
+wants_stream()
+    True if the client asked for a streamed export of the whole collection,
+    either via "stream=true" or by accepting NDJSON
+'''
+
+
+def wants_stream():
+    return (request.args.get('stream') == 'true' or wants_ndjson())
+
+
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']
+    ) == 'application/x-ndjson'
+
+
+'''
+stream_rows(model, key, filters, after, fields)
+    streams every matching row as JSON (or NDJSON), reading the table through
+    a server-side cursor in batches of STREAM_BATCH_SIZE rows, so memory use
+    stays flat regardless of the number of rows exported
+'''
+
+
+def stream_rows(model, key, filters, after=None, fields=None):
+    statement, format_row = model.select_rows(fields or model.FIELDS,
+                                              filters, after)
+    statement = statement.execution_options(
+        stream_results=True, max_row_buffer=STREAM_BATCH_SIZE)
+    ndjson = wants_ndjson()
+
+    def generate():
+        if not ndjson:
+            yield '{"%s": [' % key
+        chunk = []
+        separator = '' if ndjson else ', '
+        first = True
+        for row in db.session.execute(statement):
+            item = json.dumps(format_row(row), sort_keys=True)
+            if ndjson:
+                chunk.append(item + '\n')
+            else:
+                chunk.append(item if first else separator + item)
+                first = False
+            if len(chunk) >= STREAM_BATCH_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+        if not ndjson:
+            yield '], "success": true}'
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+'''
+get_last_event_id()
+    the sequence number a change stream resumes after: the Last-Event-ID
+    header (which EventSource sends when it reconnects) or the "after"
+    argument, or None to start with the next change
+'''
+
+
+def get_last_event_id():
+    value = request.headers.get('Last-Event-ID') or request.args.get('after')
+    if value is None:
+        return None
+    try:
+        last = int(value)
+    except ValueError:
+        abort(400)
+    if last < 0:
+        abort(400)
+    return last
+
+
+'''
+get_change_resources()
+    reads the "resources" argument (a comma-separated list of "actors",
+    "movies" and "castings") from the request, by default all of them
+'''
+
+
+def get_change_resources():
+    value = request.args.get('resources')
+    if value is None:
+        return changes.RESOURCES
+    resources = tuple(value.split(','))
+    if any(resource not in changes.RESOURCES for resource in resources):
+        abort(400)
+    return resources
+
+
+'''
+get_filter_arg(name, parse)
+    reads an optional filter argument from the request, parsed with "parse"
+'''
+
+
+def get_filter_arg(name, parse):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse(value)
+    except (KeyError, ValueError):
+        abort(400)
+
+
+'''
+get_ids_filter(model)
+    reads the "ids" argument (a comma-separated list of ids) from the request
+    returns a list containing one "id IN (...)" clause, or an empty list
+'''
+
+
+def get_ids_filter(model):
+    ids = get_filter_arg(
+        'ids', lambda value: [int(i) for i in value.split(',')])
+    if ids is None:
+        return []
+    if len(ids) > MAX_ITEMS_PER_PAGE:
+        abort(400)
+    return [model.id.in_(ids)]
+
+
+'''
+get_actor_filters() / get_movie_filters()
+    build the SQL filter clauses for the collection filter arguments
+'''
+
+
+def get_actor_filters():
+    filters = get_ids_filter(Actor)
+    gender = get_filter_arg('gender', Gender.__getitem__)
+    min_age = get_filter_arg('min_age', int)
+    max_age = get_filter_arg('max_age', int)
+    if gender is not None:
+        filters.append(Actor.gender == gender)
+    if min_age is not None:
+        filters.append(Actor.age >= min_age)
+    if max_age is not None:
+        filters.append(Actor.age <= max_age)
+    return filters
+
+
+def get_movie_filters():
+    filters = get_ids_filter(Movie)
+    released_from = get_filter_arg('released_from', date.fromisoformat)
+    released_to = get_filter_arg('released_to', date.fromisoformat)
+    if released_from is not None:
+        filters.append(Movie.release_date >= released_from)
+    if released_to is not None:
+        filters.append(Movie.release_date <= released_to)
+    return filters
+
+
+'''
+validate_actor(data, partial) / validate_movie(data, partial)
+    check one request item and convert it into column values
+    raise ValueError with a message if the item is invalid
+    with partial=True only the given fields are checked (for updates)
+'''
+
+
+def validate_actor(data, partial=False):
+    if not isinstance(data, dict):
+        raise ValueError("item must be an object")
+    values = {}
+    if "name" in data:
+        if not isinstance(data["name"], str) or not data["name"]:
+            raise ValueError("invalid name")
+        values["name"] = data["name"]
+    elif not partial:
+        raise ValueError("name is required")
+    if "age" in data or not partial:
+        age = data.get("age")
+        if age is not None:
+            age = parse_age(age)
+        values["age"] = age
+    if "gender" in data or not partial:
+        gender = data.get("gender")
+        if gender is not None:
+            if gender not in Gender.__members__:
+                raise ValueError("invalid gender")
+            gender = Gender[gender]
+        values["gender"] = gender
+    return values
+
+
+'''
+parse_age(value)
+    an age from 0 to MAX_AGE, given as an integer or (e.g. in imported CSV
+    files) a string of digits; raises ValueError for anything else,
+    including booleans and fractional numbers
+'''
+
+
+def parse_age(value):
+    if isinstance(value, bool):
+        raise ValueError("invalid age")
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if not isinstance(value, int) or not 0 <= value <= MAX_AGE:
+        raise ValueError("invalid age")
+    return value
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and \
+        1 <= value <= MAX_ID
+
+
+def validate_movie(data, partial=False):
+    if not isinstance(data, dict):
+        raise ValueError("item must be an object")
+    values = {}
+    if "title" in data:
+        if not isinstance(data["title"], str) or not data["title"]:
+            raise ValueError("invalid title")
+        values["title"] = data["title"]
+    elif not partial:
+        raise ValueError("title is required")
+    if "release_date" in data or not partial:
+        try:
+            values["release_date"] = date.fromisoformat(data["release_date"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("invalid release_date")
+    return values
+
+
+def item_error(index, status_code, message):
+    return {"index": index, "error": status_code, "message": message}
+
+
+'''
+get_bulk_items()
+    reads the JSON array of items from the body of a bulk request
+'''
+
+
+def get_bulk_items():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or len(items) > MAX_BULK_ITEMS:
+        abort(400)
+    return items
+
+
+'''
+bulk_create(model, items, validate)
+    validates all items in one pass, checks uniqueness with one IN (...)
+    query and inserts the valid items in a single transaction
+    returns the created items and the per-item errors
+'''
+
+
+def bulk_create(model, items, validate):
+    key = model.UNIQUE_FIELD
+    errors = []
+    rows = {}
+    for index, item in enumerate(items):
+        try:
+            row = validate(item)
+        except ValueError as e:
+            errors.append(item_error(index, 422, str(e)))
+            continue
+        if row[key] in rows:
+            errors.append(item_error(index, 422, "duplicate " + key))
+            continue
+        rows[row[key]] = (index, row)
+    for value in model.existing_unique(rows):
+        index, row = rows.pop(value)
+        errors.append(item_error(index, 422, key + " already exists"))
+    try:
+        created = model.bulk_insert([row for index, row in rows.values()])
+    except IntegrityError:
+        abort(422)
+    created.sort(key=lambda m: rows[getattr(m, key)][0])
+    errors.sort(key=lambda e: e["index"])
+    return [m.format() for m in created], errors
+
+
+'''
+bulk_update(model, items, validate)
+    validates all items in one pass, loads the rows to update with one
+    IN (...) query and updates them in a single transaction
+    returns the updated items and the per-item errors
+'''
+
+
+def bulk_update(model, items, validate):
+    key = model.UNIQUE_FIELD
+    errors = []
+    updates = {}
+    for index, item in enumerate(items):
+        try:
+            item_id = item["id"]
+            if not is_id(item_id):
+                raise ValueError("invalid id")
+            values = validate(item, partial=True)
+        except (KeyError, TypeError):
+            errors.append(item_error(index, 422, "id is required"))
+            continue
+        except ValueError as e:
+            errors.append(item_error(index, 422, str(e)))
+            continue
+        if item_id in updates:
+            errors.append(item_error(index, 422, "duplicate id"))
+            continue
+        updates[item_id] = (index, values)
+    found = {m.id: m for m in model.find_ids(updates)}
+    for item_id in list(updates):
+        if item_id not in found:
+            index, values = updates.pop(item_id)
+            errors.append(item_error(index, 404, "resource not found"))
+    # unique values may only be taken by the row being updated
+    claimed = {}
+    for item_id, (index, values) in list(updates.items()):
+        if key not in values:
+            continue
+        if values[key] in claimed:
+            updates.pop(item_id)
+            errors.append(item_error(index, 422, "duplicate " + key))
+            continue
+        claimed[values[key]] = item_id
+    for value in model.existing_unique(claimed):
+        item_id = claimed[value]
+        if getattr(found[item_id], key) != value:
+            index, values = updates.pop(item_id)
+            errors.append(item_error(index, 422, key + " already exists"))
+    updated = []
+    mappings = []
+    for item_id, (index, values) in sorted(updates.items(),
+                                           key=lambda u: u[1][0]):
+        item = found[item_id].format()
+        item.update({k: format_value(v) for k, v in values.items()})
+        updated.append(item)
+        mappings.append(dict(values, id=item_id))
+    try:
+        model.bulk_update(mappings)
+    except IntegrityError:
+        abort(422)
+    errors.sort(key=lambda e: e["index"])
+    return updated, errors
+
+
+'''
+bulk_delete(model, items)
+    deletes the rows whose ids are given, with one IN (...) query to find
+    the existing rows and one DELETE statement
+    returns the deleted ids and the per-item errors
+'''
+
+
+def bulk_delete(model, items):
+    errors = []
+    ids = {}
+    for index, item_id in enumerate(items):
+        if not is_id(item_id):
+            errors.append(item_error(index, 422, "invalid id"))
+        elif item_id in ids:
+            errors.append(item_error(index, 422, "duplicate id"))
+        else:
+            ids[item_id] = index
+    existing = model.existing_ids(ids)
+    for item_id, index in ids.items():
+        if item_id not in existing:
+            errors.append(item_error(index, 404, "resource not found"))
+    deleted = [item_id for item_id in ids if item_id in existing]
+    model.bulk_delete(deleted)
+    errors.sort(key=lambda e: e["index"])
+    return deleted, errors
+
+
+'''
+jsonify(*args, **kwargs)
+    flask.jsonify, encoded by the app's serializer (see serializer.py) and
+    timed as the "serialize" phase of the request
+    falls back to flask.jsonify for non-default JSON settings (e.g. pretty
+    printing in debug mode) and values the serializer can't encode
+'''
+
+
+def jsonify(*args, **kwargs):
+    with metrics.timer('serialize_duration_seconds'):
+        config = current_app.config
+        if args and kwargs or current_app.debug or \
+                config['JSONIFY_PRETTYPRINT_REGULAR'] or \
+                not config['JSON_SORT_KEYS'] or not config['JSON_AS_ASCII']:
+            return flask_jsonify(*args, **kwargs)
+        data = args[0] if len(args) == 1 else args or kwargs
+        try:
+            body = current_app.extensions['serializer'].dumps(data)
+        except TypeError:
+            return flask_jsonify(*args, **kwargs)
+        return current_app.response_class(
+            body + b'\n', mimetype=config['JSONIFY_MIMETYPE'])
+
+
+'''
+create_app(test_config)
+    the app factory; it neither connects to the database nor touches the
+    schema, which is managed by the migrations only (see manage.py)
+    test_config is a mapping of config values that override the defaults,
+    e.g. SQLALCHEMY_DATABASE_URI instead of the DATABASE_URL variable
+'''
+
 
 def create_app(test_config=None):
+    started = time.perf_counter()
 
     app = Flask(__name__)
+    app.config.from_mapping(test_config or {})
+    app.extensions['serializer'] = get_serializer(
+        app.config.get('JSON_SERIALIZER'))
     setup_db(app)
+    metrics.init_app(app, db.get_engine(app))
+    ratelimit.init_app(app)
+    compression.init_app(app)
+    querywatch.init_app(app, db.get_engine(app))
+    changes.init_app(app, db.get_engine(app))
+    for replica in get_replica_set(app).replicas:
+        metrics.instrument_engine(replica.engine)
+        querywatch.watch_engine(app, replica.engine)
     CORS(app)
 
     # mini-frontend "Home" page, redirects to login page
@@ -42,34 +661,183 @@ def create_app(test_config=None):
     def callback_page():
         return render_template("callback.html")
 
+    # GET /metrics, in the Prometheus text format
+    @app.route('/metrics')
+    def get_metrics():
+        auth_header = request.headers.get('Authorization')
+        if METRICS_TOKEN and auth_header != f'Bearer {METRICS_TOKEN}':
+            raise AuthError({
+                'code': 'invalid_metrics_token',
+                'description': 'Metrics token missing or invalid.'
+            }, 401)
+        return Response(metrics.render(metrics.registry.collect()),
+                        mimetype='text/plain; version=0.0.4')
+
     # GET /actors
     @app.route('/actors')
     @requires_auth(permission="get:actors")
+    @read_replica
+    @conditional_response(Actor.__tablename__, collection_version,
+                          bypass=wants_stream)
+    @cached_response(Actor.__tablename__, bypass=wants_stream,
+                     version=collection_version)
     def get_actors(payload):
-        all_actors = Actor.query.all()
-        actors = []
-        for actor in all_actors:
-            actors.append(actor.format())
-        return jsonify({"success": True, "actors": actors})
+        limit, after = get_page_args()
+        fields = get_fields(Actor)
+        filters = get_actor_filters()
+        include = get_include('movies')
+        if wants_stream():
+            if include:
+                abort(400)
+            return stream_rows(Actor, 'actors', filters, after, fields)
+        actors, next_after = paginate(Actor, filters, limit, after, fields,
+                                      include)
+        return jsonify({"success": True, "actors": actors,
+                        "next": next_after})
 
     # GET /movies
     @app.route('/movies')
     @requires_auth(permission="get:movies")
+    @read_replica
+    @conditional_response(Movie.__tablename__, collection_version,
+                          bypass=wants_stream)
+    @cached_response(Movie.__tablename__, bypass=wants_stream,
+                     version=collection_version)
     def get_movies(payload):
-        all_movies = Movie.query.all()
-        movies = []
-        for movie in all_movies:
-            movies.append(movie.format())
-        return jsonify({"success": True, "movies": movies})
+        limit, after = get_page_args()
+        fields = get_fields(Movie)
+        filters = get_movie_filters()
+        include = get_include('actors')
+        if wants_stream():
+            if include:
+                abort(400)
+            return stream_rows(Movie, 'movies', filters, after, fields)
+        movies, next_after = paginate(Movie, filters, limit, after, fields,
+                                      include)
+        return jsonify({"success": True, "movies": movies,
+                        "next": next_after})
+
+    # GET /stats
+    @app.route('/stats')
+    @requires_auth(permission="get:actors")
+    @read_replica
+    def get_stats(payload):
+        check_permissions("get:movies", payload)
+        return jsonify(dict(Stats.summary(), success=True))
+
+    # GET /changes/stream, as server-sent events (see changes.py)
+    @app.route('/changes/stream')
+    @requires_auth(permission="get:actors")
+    def get_changes_stream(payload):
+        check_permissions("get:movies", payload)
+        if not changes.CHANGES_ENABLED:
+            abort(404)
+        after = get_last_event_id()
+        resources = get_change_resources()
+        feed = app.extensions['changes']
+        subscription = feed.subscribe() if feed.live() else None
+        response = Response(
+            stream_with_context(changes.stream_events(
+                feed, subscription, after, resources)),
+            mimetype='text/event-stream')
+        if subscription is not None:
+            response.call_on_close(
+                lambda: feed.unsubscribe(subscription))
+        response.headers['Cache-Control'] = 'no-cache'
+        # e.g. nginx would otherwise buffer the events
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    # GET /actors/search
+    @app.route('/actors/search')
+    @requires_auth(permission="get:actors")
+    @read_replica
+    @conditional_response(Actor.__tablename__, TableVersion.current)
+    @cached_response(Actor.__tablename__, version=TableVersion.current)
+    def search_actors(payload):
+        actors, next_offset = search_page(Actor)
+        return jsonify({"success": True, "actors": actors,
+                        "next": next_offset})
+
+    # GET /movies/search
+    @app.route('/movies/search')
+    @requires_auth(permission="get:movies")
+    @read_replica
+    @conditional_response(Movie.__tablename__, TableVersion.current)
+    @cached_response(Movie.__tablename__, version=TableVersion.current)
+    def search_movies(payload):
+        movies, next_offset = search_page(Movie)
+        return jsonify({"success": True, "movies": movies,
+                        "next": next_offset})
+
+    # GET /actors/id
+    @app.route('/actors/<int:actor_id>')
+    @requires_auth(permission="get:actors")
+    @read_replica
+    @conditional_response(Actor.__tablename__, TableVersion.current)
+    def get_actor(payload, actor_id):
+        actor = Actor.query.get(actor_id)
+        if not actor:
+            abort(404)
+        return jsonify({'success': True, 'actors': [actor.format()]})
+
+    # GET /movies/id
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth(permission="get:movies")
+    @read_replica
+    @conditional_response(Movie.__tablename__, TableVersion.current)
+    def get_movie(payload, movie_id):
+        movie = Movie.query.get(movie_id)
+        if not movie:
+            abort(404)
+        return jsonify({'success': True, 'movies': [movie.format()]})
+
+    # GET /actors/id/movies
+    @app.route('/actors/<int:actor_id>/movies')
+    @requires_auth(permission="get:movies")
+    @read_replica
+    def get_actor_movies(payload, actor_id):
+        movies, next_after = paginate_cast(Actor, actor_id, Movie)
+        return jsonify({"success": True, "movies": movies,
+                        "next": next_after})
+
+    # GET /movies/id/actors
+    @app.route('/movies/<int:movie_id>/actors')
+    @requires_auth(permission="get:actors")
+    @read_replica
+    def get_movie_actors(payload, movie_id):
+        actors, next_after = paginate_cast(Movie, movie_id, Actor)
+        return jsonify({"success": True, "actors": actors,
+                        "next": next_after})
+
+    # PUT /movies/id/actors/id
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['PUT'])
+    @requires_auth(permission="patch:movies")
+    def assign_actor(payload, movie_id, actor_id):
+        movie = Movie.query.get(movie_id)
+        if not movie or not Actor.query.get(actor_id):
+            abort(404)
+        movie.assign(actor_id)
+        return jsonify({'success': True, 'movie': movie_id,
+                        'actor': actor_id})
+
+    # DELETE /movies/id/actors/id
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['DELETE'])
+    @requires_auth(permission="patch:movies")
+    def unassign_actor(payload, movie_id, actor_id):
+        movie = Movie.query.get(movie_id)
+        if not movie or not movie.unassign(actor_id):
+            abort(404)
+        return jsonify({'success': True, 'movie': movie_id,
+                        'actor': actor_id})
 
     # DELETE /actors/id
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth(permission="delete:actors")
     def delete_actors(payload, actor_id):
-        actor = Actor.query.get(actor_id)
-        if actor:
-            actor.delete()
-        else:
+        if not Actor.delete_row(actor_id):
             abort(404)
         return jsonify({'success': True, 'delete': actor_id})
 
@@ -77,10 +845,7 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth(permission="delete:movies")
     def delete_movies(payload, movie_id):
-        movie = Movie.query.get(movie_id)
-        if movie:
-            movie.delete()
-        else:
+        if not Movie.delete_row(movie_id):
             abort(404)
         return jsonify({'success': True, 'delete': movie_id})
 
@@ -88,72 +853,113 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['POST'])
     @requires_auth(permission="post:actors")
     def post_actors(payload):
-        data = request.get_json()
-        if "name" not in data:
-            abort (422)
-        check_actor = Actor.query.filter(Actor.name == data["name"]).one_or_none()
-        if check_actor:
+        try:
+            values = validate_actor(request.get_json(silent=True))
+        except ValueError:
             abort(422)
-        new_actor = Actor(
-            name=data["name"],
-            age=data["age"],
-            gender=data["gender"])
-        new_actor.insert()
-        return jsonify({'success': True, 'actors': [new_actor.format()]})
+        try:
+            actor = Actor.insert_row(values)
+        except IntegrityError:
+            # the name is taken
+            abort(422)
+        return jsonify({'success': True, 'actors': [actor]})
 
     # POST /movies
     @app.route('/movies', methods=['POST'])
     @requires_auth(permission="post:movies")
     def post_movies(payload):
-        data = request.get_json()
-        check_movie = Movie.query.filter(Movie.title == data["title"]).one_or_none()
         try:
-            assert not check_movie
-            assert "title" in data
-            release_date = date.fromisoformat(data["release_date"])
-        except:
+            values = validate_movie(request.get_json(silent=True))
+        except ValueError:
+            abort(422)
+        try:
+            movie = Movie.insert_row(values)
+        except IntegrityError:
+            # the title is taken
             abort(422)
-        new_movie = Movie(
-            title=data["title"],
-            release_date=release_date)
-        new_movie.insert()
-        return jsonify({'success': True, 'movies': [new_movie.format()]})
+        return jsonify({'success': True, 'movies': [movie]})
 
     # PATCH /actors/id
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth(permission="patch:actors")
     def patch_actors(payload, actor_id):
-        data = request.get_json()
-        actor = Actor.query.get(actor_id)
-        if not actor:
+        try:
+            values = validate_actor(request.get_json(silent=True),
+                                    partial=True)
+        except ValueError:
+            abort(422)
+        try:
+            actor = Actor.update_row(actor_id, values)
+        except IntegrityError:
+            abort(422)
+        if actor is None:
             abort(404)
-        if "name" in data:
-            actor.name = data["name"]
-        if "age" in data:
-            actor.age = data["age"]
-        if "gender" in data:
-            actor.gender = data["gender"]
-        actor.update()
-        return jsonify({'success': True, 'actors': [actor.format()]})
-    
+        return jsonify({'success': True, 'actors': [actor]})
+
     # PATCH /movies/id
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth(permission="patch:movies")
     def patch_movies(payload, movie_id):
-        data = request.get_json()
-        movie = Movie.query.get(movie_id)
-        if not movie:
+        try:
+            values = validate_movie(request.get_json(silent=True),
+                                    partial=True)
+        except ValueError:
+            abort(422)
+        try:
+            movie = Movie.update_row(movie_id, values)
+        except IntegrityError:
+            abort(422)
+        if movie is None:
             abort(404)
-        if "title" in data:
-            movie.title = data["title"]
-        if "release_date" in data:
-            try:
-                release_date = date.fromisoformat(data["release_date"])
-            except:
-                abort(422)
-            movie.release_date = release_date
-        movie.update()
-        return jsonify({'success': True, 'movies': [movie.format()]})
+        return jsonify({'success': True, 'movies': [movie]})
+
+    # POST /actors/bulk
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth(permission="post:actors")
+    @query_budget(BULK_QUERY_BUDGET, repeats=BULK_CHUNKS)
+    def post_actors_bulk(payload):
+        actors, errors = bulk_create(Actor, get_bulk_items(), validate_actor)
+        return jsonify({'success': True, 'actors': actors, 'errors': errors})
+
+    # POST /movies/bulk
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth(permission="post:movies")
+    @query_budget(BULK_QUERY_BUDGET, repeats=BULK_CHUNKS)
+    def post_movies_bulk(payload):
+        movies, errors = bulk_create(Movie, get_bulk_items(), validate_movie)
+        return jsonify({'success': True, 'movies': movies, 'errors': errors})
+
+    # PATCH /actors/bulk
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth(permission="patch:actors")
+    @query_budget(BULK_QUERY_BUDGET, repeats=BULK_CHUNKS)
+    def patch_actors_bulk(payload):
+        actors, errors = bulk_update(Actor, get_bulk_items(), validate_actor)
+        return jsonify({'success': True, 'actors': actors, 'errors': errors})
+
+    # PATCH /movies/bulk
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth(permission="patch:movies")
+    @query_budget(BULK_QUERY_BUDGET, repeats=BULK_CHUNKS)
+    def patch_movies_bulk(payload):
+        movies, errors = bulk_update(Movie, get_bulk_items(), validate_movie)
+        return jsonify({'success': True, 'movies': movies, 'errors': errors})
+
+    # DELETE /actors/bulk
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth(permission="delete:actors")
+    @query_budget(BULK_QUERY_BUDGET, repeats=BULK_CHUNKS)
+    def delete_actors_bulk(payload):
+        deleted, errors = bulk_delete(Actor, get_bulk_items())
+        return jsonify({'success': True, 'delete': deleted, 'errors': errors})
+
+    # DELETE /movies/bulk
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth(permission="delete:movies")
+    @query_budget(BULK_QUERY_BUDGET, repeats=BULK_CHUNKS)
+    def delete_movies_bulk(payload):
+        deleted, errors = bulk_delete(Movie, get_bulk_items())
+        return jsonify({'success': True, 'delete': deleted, 'errors': errors})
 
     """
     ERROR HANDLERS TAKEN FROM MY COFFEE_SHOP PROJECT SUBMISSION
@@ -193,9 +999,25 @@ def create_app(test_config=None):
                         "error": error.status_code,
                         "message": error.error
                         }), error.status_code
+
+    @app.errorhandler(RateLimitError)
+    def rate_limit_error(error):
+        response = jsonify({
+                            "success": False,
+                            "error": error.status_code,
+                            "message": error.error
+                            })
+        response.status_code = error.status_code
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
+    app.config["STARTUP_SECONDS"] = time.perf_counter() - started
+    if app.config["STARTUP_SECONDS"] > STARTUP_TARGET_SECONDS:
+        app.logger.warning("create_app took %.3fs (target: %.3fs)",
+                           app.config["STARTUP_SECONDS"],
+                           STARTUP_TARGET_SECONDS)
     return app
 
-app = create_app()
 
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    create_app().run()
\ No newline at end of file
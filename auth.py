@@ -1,8 +1,15 @@
+import hashlib
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+from jose import jwt, JWTError
 from urllib.request import urlopen
+from metrics import timer
+from ratelimit import check_rate_limit
 
 """
 THIS ENTIRE FILE MOSTLY RECYCLED FROM THE COFFEE_SHOP CLASS PROJECT
@@ -12,6 +19,28 @@ AUTH0_DOMAIN = 'vbrech.eu.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone_api'
 
+# JWKS_URL may point at a local file (plain path or file:// URL) or any other
+# URL serving a JWKS document, e.g. a stand-in for offline testing
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# seconds a fetched key set is considered fresh
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+# seconds before expiry at which a background refresh is started
+JWKS_REFRESH_AHEAD = int(os.environ.get('JWKS_REFRESH_AHEAD', 60))
+# minimum seconds between two refetches triggered by an unknown kid
+JWKS_MIN_REFETCH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+# seconds past expiry for which stale keys are served while the JWKS
+# endpoint is unreachable
+JWKS_MAX_STALE = int(os.environ.get('JWKS_MAX_STALE', 3600))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# maximum number of verified tokens kept per worker (0 disables the cache)
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# tokens longer than this are never cached, which bounds the memory a
+# single cache entry can take up
+TOKEN_CACHE_MAX_TOKEN_BYTES = int(
+    os.environ.get('TOKEN_CACHE_MAX_TOKEN_BYTES', 8192))
+
 # AuthError Exception
 
 '''
@@ -26,6 +55,222 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS key store
+
+'''
+JWKSKeyStore
+    an in-process cache of the signing keys published in a JWKS document,
+    keyed by kid. One instance is shared by all threads of a worker process.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url=None, ttl=None, refresh_ahead=None,
+                 min_refetch_interval=None, max_stale=None,
+                 timeout=None):
+        self.url = url or JWKS_URL
+        self.ttl = JWKS_TTL if ttl is None else ttl
+        self.refresh_ahead = (JWKS_REFRESH_AHEAD if refresh_ahead is None
+                              else refresh_ahead)
+        self.min_refetch_interval = (
+            JWKS_MIN_REFETCH_INTERVAL if min_refetch_interval is None
+            else min_refetch_interval)
+        self.max_stale = JWKS_MAX_STALE if max_stale is None else max_stale
+        self.timeout = JWKS_FETCH_TIMEOUT if timeout is None else timeout
+        self.keys = {}
+        self.fetched_at = None
+        self.last_attempt = None
+        self._lock = threading.Lock()
+        self._flag_lock = threading.Lock()
+        self._refreshing = False
+
+    '''
+    get_key(kid)
+        returns the RSA key for kid, refreshing the key set as needed
+        returns None if the kid is unknown even after a refetch
+    '''
+    def get_key(self, kid):
+        now = time.monotonic()
+        if self.fetched_at is None or now - self.fetched_at >= self.ttl:
+            self._refresh_or_serve_stale()
+        elif now - self.fetched_at >= self.ttl - self.refresh_ahead:
+            self._refresh_in_background()
+        key = self.keys.get(kid)
+        if key is None and self._may_refetch():
+            # the signing key may have been rotated since the last fetch
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            key = self.keys.get(kid)
+        return key
+
+    '''
+    refresh()
+        fetches the JWKS document and replaces the cached key set
+        raises on network or parse errors, leaving the cached keys intact
+    '''
+    def refresh(self):
+        requested_at = time.monotonic()
+        with self._lock:
+            if self.fetched_at is not None and \
+                    self.fetched_at >= requested_at:
+                # another thread refreshed while we waited for the lock
+                return
+            self.last_attempt = time.monotonic()
+            jwks = self._fetch()
+            keys = {}
+            for key in jwks['keys']:
+                if key.get('kty') != 'RSA' or 'kid' not in key:
+                    continue
+                keys[key['kid']] = {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key.get('use', 'sig'),
+                    'n': key['n'],
+                    'e': key['e']
+                }
+            self.keys = keys
+            self.fetched_at = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self.keys = {}
+            self.fetched_at = None
+            self.last_attempt = None
+
+    def _fetch(self):
+        if '://' not in self.url:
+            with open(self.url) as f:
+                return json.load(f)
+        with urlopen(self.url, timeout=self.timeout) as jsonurl:
+            return json.loads(jsonurl.read())
+
+    def _may_refetch(self):
+        return (self.last_attempt is None or
+                time.monotonic() - self.last_attempt >=
+                self.min_refetch_interval)
+
+    def _refresh_or_serve_stale(self):
+        last_failed = (self.last_attempt is not None and
+                       (self.fetched_at is None or
+                        self.last_attempt > self.fetched_at))
+        # don't hammer a JWKS endpoint that is known to be down
+        if not last_failed or self._may_refetch():
+            try:
+                self.refresh()
+                return
+            except Exception:
+                pass
+        if (self.fetched_at is None or
+                time.monotonic() - self.fetched_at >=
+                self.ttl + self.max_stale):
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch signing keys.'
+            }, 503)
+
+    def _refresh_in_background(self):
+        with self._flag_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+jwks_store = JWKSKeyStore()
+
+
+# Verified token cache
+
+'''
+TokenCache
+    a bounded LRU cache of decoded JWT payloads, keyed by the SHA-256 hash of
+    the token. Entries expire at the token's exp claim.
+'''
+
+
+class TokenCache:
+    def __init__(self, max_size=None, max_token_bytes=None):
+        self.max_size = TOKEN_CACHE_SIZE if max_size is None else max_size
+        self.max_token_bytes = (TOKEN_CACHE_MAX_TOKEN_BYTES
+                                if max_token_bytes is None
+                                else max_token_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    get(token)
+        returns the cached payload for token, or None on a miss
+    '''
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, exp = entry
+                if time.time() < exp:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    '''
+    put(token, payload)
+        caches a verified payload until its exp claim
+    '''
+    def put(self, token, payload):
+        if self.max_size <= 0 or len(token) > self.max_token_bytes:
+            return
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or exp <= time.time():
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _key(self, token):
+        return hashlib.sha256(token.encode()).digest()
+
+
+token_cache = TokenCache()
+
+
 # Auth Header
 
 # the following function is taken from the provided "BasicFlaskAuth" app
@@ -78,34 +323,32 @@ def check_permissions(permission, payload):
 
 
 # the following function is taken from the provided "BasicFlaskAuth" app
+# (adapted to look up keys in the cached jwks_store)
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 401)
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    with timer('auth_phase_duration_seconds', phase='auth-jwks'):
+        rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with timer('auth_phase_duration_seconds', phase='auth-verify'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
 
             return payload
 
@@ -136,9 +379,19 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timer('auth_phase_duration_seconds', phase='auth-header'):
+                token = get_token_auth_header()
+            with timer('auth_phase_duration_seconds', phase='auth-cache'):
+                payload = token_cache.get(token)
+            if payload is None:
+                payload = verify_decode_jwt(token)
+                token_cache.put(token, payload)
+            with timer('auth_phase_duration_seconds',
+                       phase='auth-permissions'):
+                check_permissions(permission, payload)
+            # sheds the request before the route touches the database
+            check_rate_limit(permission, payload)
+            _request_ctx_stack.top.current_user = payload
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
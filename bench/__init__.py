@@ -0,0 +1,7 @@
+"""
+Load-test and micro-benchmark harness for the casting agency API.
+
+Runs entirely offline: tokens are minted with a local RSA key and verified
+against a local stand-in JWKS, and the database is a seeded SQLite (or
+PostgreSQL) fixture. See README.md ("Benchmarks") for usage.
+"""
@@ -0,0 +1,73 @@
+import random
+from datetime import date, timedelta
+
+from models import (
+    db, Actor, Movie, Gender, Stats, TableVersion, casting
+)
+
+"""
+Seeds the benchmark database with a configurable number of actors and
+movies. Rows are deterministic for a given seed, so runs are comparable.
+"""
+
+CHUNK_SIZE = 10000
+# actors cast in every movie
+CAST_SIZE = 5
+
+
+def actor_rows(count, rng):
+    genders = list(Gender)
+    for i in range(count):
+        yield {
+            'name': f'Actor {i:07d}',
+            'age': rng.randint(5, 90),
+            'gender': rng.choice(genders)
+        }
+
+
+def movie_rows(count, rng):
+    start = date(1920, 1, 1)
+    for i in range(count):
+        yield {
+            'title': f'Movie {i:07d}',
+            'release_date': start + timedelta(days=rng.randint(0, 40000))
+        }
+
+
+def casting_rows(scale, rng):
+    for movie_id in range(1, scale + 1):
+        for actor_id in rng.sample(range(1, scale + 1),
+                                   min(CAST_SIZE, scale)):
+            yield {'actor_id': actor_id, 'movie_id': movie_id}
+
+
+def insert_chunked(table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+
+
+'''
+seed(app, scale, seed)
+    drops and recreates the tables, then inserts scale actors and scale
+    movies, each movie with a cast of CAST_SIZE actors
+'''
+
+
+def seed(app, scale, seed=0):
+    rng = random.Random(seed)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        insert_chunked(Actor.__table__, actor_rows(scale, rng))
+        insert_chunked(Movie.__table__, movie_rows(scale, rng))
+        insert_chunked(casting, casting_rows(scale, rng))
+        Stats.apply(Stats.compute())
+        for model in (Actor, Movie):
+            TableVersion.bump(model.__tablename__)
+        db.session.commit()
@@ -0,0 +1,91 @@
+import base64
+import json
+import os
+import tempfile
+import time
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+import auth
+
+"""
+A local stand-in for the Auth0 tenant: an RSA keypair, a JWKS file with its
+public key and a minter for tokens that verify_decode_jwt accepts.
+"""
+
+KID = 'local-bench-key'
+
+# the permissions of the roles used in test_app.py
+ROLES = {
+    'executive_producer': [
+        'delete:actors', 'delete:movies', 'get:actors', 'get:movies',
+        'patch:actors', 'patch:movies', 'post:actors', 'post:movies'
+    ],
+    'casting_director': [
+        'delete:actors', 'get:actors', 'get:movies', 'patch:actors',
+        'patch:movies', 'post:actors'
+    ],
+    'casting_assistant': ['get:actors', 'get:movies'],
+    'no_role': []
+}
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class LocalAuth:
+    def __init__(self, jwks_path=None):
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        self.private_key = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption())
+        numbers = key.public_key().public_numbers()
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': KID,
+            'use': 'sig',
+            'n': b64url_uint(numbers.n),
+            'e': b64url_uint(numbers.e)
+        }]}
+        if jwks_path is None:
+            fd, jwks_path = tempfile.mkstemp(suffix='-jwks.json')
+            os.close(fd)
+        self.jwks_path = jwks_path
+        with open(self.jwks_path, 'w') as f:
+            json.dump(self.jwks, f)
+
+    '''
+    install()
+        points the app's JWKS key store at the local JWKS file
+    '''
+    def install(self):
+        auth.jwks_store.url = self.jwks_path
+        auth.jwks_store.clear()
+        auth.token_cache.clear()
+
+    '''
+    mint(role, sub, ttl)
+        returns a signed access token with the permissions of role
+        (a key of ROLES or a list of permissions)
+    '''
+    def mint(self, role='executive_producer', sub=None, ttl=3600):
+        permissions = ROLES[role] if isinstance(role, str) else role
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'sub': sub or 'local|' + (role if isinstance(role, str)
+                                      else 'custom'),
+            'aud': auth.API_AUDIENCE,
+            'iat': now,
+            'exp': now + ttl,
+            'scope': '',
+            'permissions': permissions
+        }
+        return jwt.encode(claims, self.private_key,
+                          algorithm=auth.ALGORITHMS[0],
+                          headers={'kid': KID})
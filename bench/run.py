@@ -0,0 +1,456 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+"""
+Benchmark runner.
+
+    python -m bench.run --scale 1000 --requests 200 --output results.json
+    python -m bench.run --mode micro --scale 10000
+    python -m bench.run --baseline old.json --output new.json
+
+Load scenarios call every API route of create_app() (in-process through the
+Flask test client, or over HTTP with --url) and report req/s and latency
+percentiles. Micro-benchmarks time the hot spots in isolation. Results are
+written as JSON; with --baseline the differences to an earlier run are
+printed.
+"""
+
+
+# ---------------------------------------------------------------------------#
+# Clients
+# ---------------------------------------------------------------------------#
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body=None):
+        res = self.client.open(path, method=method, headers=headers,
+                               json=body)
+        return res.status_code, len(res.get_data())
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, headers, body=None):
+        data = None
+        headers = dict(headers)
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        req = Request(self.base_url + path, data=data, headers=headers,
+                      method=method)
+        try:
+            with urlopen(req) as res:
+                return res.status, len(res.read())
+        except HTTPError as e:
+            return e.code, len(e.read())
+
+
+# ---------------------------------------------------------------------------#
+# Scenarios
+# ---------------------------------------------------------------------------#
+
+'''
+scenarios(scale)
+    one entry per route: (name, role, request factory). A request factory
+    takes the request number and returns (method, path, headers, body).
+    Write scenarios come last; single deletes consume rows from the top ids
+    and bulk deletes from the lower half.
+'''
+
+
+def scenarios(scale, bulk_size):
+    rng = random.Random(1)
+
+    def random_id(i):
+        return rng.randint(1, scale)
+
+    def get(path):
+        return lambda i: ('GET', path, {}, None)
+
+    def bulk_ids(i):
+        # consecutive ids from the lower half of the table
+        return [(i * bulk_size + j) % max(scale // 2, 1) + 1
+                for j in range(bulk_size)]
+
+    return [
+        ('GET /login', None, get('/login')),
+        ('GET /metrics', None, get('/metrics')),
+        ('GET /actors', 'casting_assistant', get('/actors')),
+        ('GET /actors?limit=1000', 'casting_assistant',
+         get('/actors?limit=1000')),
+        ('GET /actors?fields=name&min_age=30&max_age=40',
+         'casting_assistant',
+         get('/actors?fields=name&min_age=30&max_age=40')),
+        ('GET /actors?after=random', 'casting_assistant',
+         lambda i: ('GET', f'/actors?after={random_id(i)}', {}, None)),
+        ('GET /actors?ids=10', 'casting_assistant',
+         lambda i: ('GET', '/actors?ids=' + ','.join(
+             str(random_id(i)) for _ in range(10)), {}, None)),
+        ('GET /actors/<id>', 'casting_assistant',
+         lambda i: ('GET', f'/actors/{random_id(i)}', {}, None)),
+        ('GET /movies', 'casting_assistant', get('/movies')),
+        ('GET /movies?released_from=1990-01-01', 'casting_assistant',
+         get('/movies?released_from=1990-01-01')),
+        ('GET /movies/<id>', 'casting_assistant',
+         lambda i: ('GET', f'/movies/{random_id(i)}', {}, None)),
+        ('GET /actors/search?q=actor 00', 'casting_assistant',
+         get('/actors/search?q=actor%2000')),
+        ('GET /movies/search?q=random', 'casting_assistant',
+         lambda i: ('GET', f'/movies/search?q={random_id(i):07d}', {},
+                    None)),
+        ('GET /stats', 'casting_assistant', get('/stats')),
+        ('GET /movies?include=actors', 'casting_assistant',
+         get('/movies?include=actors')),
+        ('GET /movies/<id>/actors', 'casting_assistant',
+         lambda i: ('GET', f'/movies/{random_id(i)}/actors', {}, None)),
+        ('GET /actors/<id>/movies', 'casting_assistant',
+         lambda i: ('GET', f'/actors/{random_id(i)}/movies', {}, None)),
+        ('GET /actors (stream)', 'casting_assistant',
+         get('/actors?stream=true')),
+        ('GET /movies (ndjson)', 'casting_assistant',
+         lambda i: ('GET', '/movies',
+                    {'Accept': 'application/x-ndjson'}, None)),
+        ('POST /actors', 'executive_producer',
+         lambda i: ('POST', '/actors', {}, {
+             'name': f'Bench Actor {time.time_ns()}-{i}',
+             'age': 30,
+             'gender': 'other'})),
+        ('POST /movies', 'executive_producer',
+         lambda i: ('POST', '/movies', {}, {
+             'title': f'Bench Movie {time.time_ns()}-{i}',
+             'release_date': '2020-01-01'})),
+        ('PATCH /actors/<id>', 'executive_producer',
+         lambda i: ('PATCH', f'/actors/{random_id(i)}', {}, {'age': 40})),
+        ('PATCH /movies/<id>', 'executive_producer',
+         lambda i: ('PATCH', f'/movies/{random_id(i)}', {},
+                    {'release_date': '2021-01-01'})),
+        ('PUT /movies/<id>/actors/<id>', 'casting_director',
+         lambda i: ('PUT', f'/movies/{random_id(i)}/actors/{random_id(i)}',
+                    {}, None)),
+        ('POST /actors/bulk', 'executive_producer',
+         lambda i: ('POST', '/actors/bulk', {}, [
+             {'name': f'Bulk Actor {time.time_ns()}-{i}-{j}', 'age': 20}
+             for j in range(bulk_size)])),
+        ('PATCH /movies/bulk', 'executive_producer',
+         lambda i: ('PATCH', '/movies/bulk', {}, [
+             {'id': movie_id, 'release_date': '2022-01-01'}
+             for movie_id in bulk_ids(i)])),
+        ('DELETE /actors/<id>', 'executive_producer',
+         lambda i: ('DELETE', f'/actors/{scale - i}', {}, None)),
+        ('DELETE /movies/<id>', 'executive_producer',
+         lambda i: ('DELETE', f'/movies/{scale - i}', {}, None)),
+        ('DELETE /actors/bulk', 'executive_producer',
+         lambda i: ('DELETE', '/actors/bulk', {}, bulk_ids(i))),
+    ]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(p / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_scenario(client, tokens, role, factory, requests, concurrency,
+                 warmup, extra_headers=None):
+    def one(i):
+        method, path, headers, body = factory(i)
+        if role:
+            headers = dict(headers, Authorization='Bearer ' + tokens[role])
+        if extra_headers:
+            headers = dict(headers, **extra_headers)
+        start = time.perf_counter()
+        status, size = client.request(method, path, headers, body)
+        return time.perf_counter() - start, status, size
+
+    for i in range(warmup):
+        one(requests + i)
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(one, range(requests)))
+    else:
+        results = [one(i) for i in range(requests)]
+    elapsed = time.perf_counter() - started
+    # of this process: the app's and the client's in-process, the
+    # client's only with --url
+    cpu = time.process_time() - cpu_started
+    latencies = sorted(r[0] * 1000 for r in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for r in results if r[1] >= 400),
+        'rps': requests / elapsed if elapsed else 0.0,
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'bytes_per_response': sum(r[2] for r in results) / len(results),
+        'cpu_ms_per_request': cpu * 1000 / requests
+    }
+
+
+def run_load(client, tokens, args):
+    results = {}
+    extra_headers = ({'Accept-Encoding': args.accept_encoding}
+                     if args.accept_encoding else None)
+    for name, role, factory in scenarios(args.scale, args.bulk_size):
+        if args.only and args.only not in name:
+            continue
+        results[name] = run_scenario(client, tokens, role, factory,
+                                     args.requests, args.concurrency,
+                                     args.warmup, extra_headers)
+        print_row(name, results[name])
+    return results
+
+
+# ---------------------------------------------------------------------------#
+# Micro-benchmarks
+# ---------------------------------------------------------------------------#
+
+def timed(fn, ops):
+    start = time.perf_counter()
+    for _ in range(ops):
+        fn()
+    elapsed = time.perf_counter() - start
+    return {'ops': ops, 'us_per_op': elapsed / ops * 1e6}
+
+
+def peak_bytes(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_micro(app, tokens, args):
+    import auth
+    from flask import jsonify
+    from compression import Compression
+    from sqlalchemy import select
+    from models import Actor, db
+    from serializer import SERIALIZERS
+
+    token = tokens['executive_producer']
+    results = {}
+    auth.verify_decode_jwt(token)
+    results['verify_decode_jwt'] = timed(
+        lambda: auth.verify_decode_jwt(token), args.micro_ops)
+    auth.token_cache.put(token, auth.verify_decode_jwt(token))
+    results['token_cache_hit+check_permissions'] = timed(
+        lambda: auth.check_permissions('get:actors',
+                                       auth.token_cache.get(token)),
+        args.micro_ops)
+    with app.app_context():
+        actors = Actor.query.order_by(Actor.id).limit(args.rows).all()
+        rows = len(actors)
+        results[f'Actor.format x{rows}'] = timed(
+            lambda: [actor.format() for actor in actors], args.micro_ops)
+        columns, format_row = Actor.row_format(Actor.FIELDS)
+        tuples = db.session.execute(
+            select(columns).order_by(Actor.id).limit(args.rows)).fetchall()
+        results[f'Actor.row_format x{rows}'] = timed(
+            lambda: [format_row(row) for row in tuples], args.micro_ops)
+
+        # with an empty identity map, as at the start of a request
+        def load_models():
+            db.session.expunge_all()
+            return [actor.format() for actor in
+                    Actor.query.order_by(Actor.id).limit(args.rows)]
+
+        def select_rows():
+            db.session.expunge_all()
+            statement, format_row = Actor.select_rows(Actor.FIELDS,
+                                                      limit=args.rows)
+            return [format_row(row) for row in db.session.execute(statement)]
+
+        for name, load in (('load models + format', load_models),
+                           ('select_rows + row_format', select_rows)):
+            result = timed(load, args.micro_ops)
+            result['bytes_per_row'] = peak_bytes(load) / max(rows, 1)
+            results[f'{name} x{rows}'] = result
+        formatted = [actor.format() for actor in actors]
+        results[f'jsonify x{rows}'] = timed(
+            lambda: jsonify({'success': True, 'actors': formatted}),
+            args.micro_ops)
+        for name, serializer in SERIALIZERS.items():
+            try:
+                dumps = serializer().dumps
+            except RuntimeError:
+                continue
+            results[f'{name} dumps x{rows}'] = timed(
+                lambda: dumps({'success': True, 'actors': formatted}),
+                args.micro_ops)
+        body = jsonify({'success': True, 'actors': formatted}).get_data()
+        compression = Compression()
+        for encoding, levels in (('gzip', (1, 6, 9)), ('br', (1, 4, 11))):
+            if encoding not in compression.encodings:
+                continue
+            for level in levels:
+                compression.gzip_level = compression.brotli_quality = level
+                result = timed(
+                    lambda: compression.compress(body, encoding),
+                    args.micro_ops)
+                result['bytes'] = len(compression.compress(body, encoding))
+                results[f'{encoding}-{level} x{rows}'] = result
+        results[f'uncompressed x{rows}'] = {'ops': 0, 'us_per_op': 0.0,
+                                            'bytes': len(body)}
+    for name, result in results.items():
+        memory = (f'  {result["bytes_per_row"]:8.0f} bytes/row (peak)'
+                  if 'bytes_per_row' in result else '')
+        if 'bytes' in result:
+            memory = f'  {result["bytes"]:8d} bytes'
+        print(f'{name:45} {result["us_per_op"]:12.1f} us/op{memory}')
+    return results
+
+
+# ---------------------------------------------------------------------------#
+# Reporting
+# ---------------------------------------------------------------------------#
+
+def print_row(name, result):
+    print(f'{name:45} {result["rps"]:9.1f} req/s  '
+          f'p50 {result["p50_ms"]:8.2f}  p95 {result["p95_ms"]:8.2f}  '
+          f'p99 {result["p99_ms"]:8.2f} ms  errors {result["errors"]}  '
+          f'{result["bytes_per_response"]:10.0f} B/resp  '
+          f'cpu {result.get("cpu_ms_per_request", 0):7.2f} ms/req')
+
+
+def compare(baseline, results):
+    print('\nChanges against baseline:')
+    for section, key, lower_is_better in (('load', 'p50_ms', True),
+                                          ('load', 'rps', False),
+                                          ('load', 'bytes_per_response',
+                                           True),
+                                          ('load', 'cpu_ms_per_request',
+                                           True),
+                                          ('micro', 'us_per_op', True),
+                                          ('micro', 'bytes_per_row', True),
+                                          ('micro', 'bytes', True)):
+        for name, result in results.get(section, {}).items():
+            old = baseline.get(section, {}).get(name)
+            if not old or not old.get(key) or key not in result:
+                continue
+            change = (result[key] - old[key]) / old[key] * 100
+            worse = change > 0 if lower_is_better else change < 0
+            flag = '  <-- regression' if worse and abs(change) > 10 else ''
+            print(f'{name:45} {key:10} {old[key]:10.2f} -> '
+                  f'{result[key]:10.2f} ({change:+.1f}%){flag}')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the casting agency API.')
+    parser.add_argument('--mode', choices=['load', 'micro', 'all'],
+                        default='all')
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='actors and movies to seed (e.g. 1000, '
+                             '100000, 1000000)')
+    parser.add_argument('--database-url',
+                        help='database to seed and benchmark against '
+                             '(default: a temporary SQLite file)')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse the data already in the database')
+    parser.add_argument('--url', help='benchmark a running server over '
+                                      'HTTP instead of in-process')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--bulk-size', type=int, default=100)
+    parser.add_argument('--only', help='only run scenarios containing this')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='rows per micro-benchmark operation')
+    parser.add_argument('--micro-ops', type=int, default=200)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the response cache')
+    parser.add_argument('--accept-encoding',
+                        help='send this Accept-Encoding header (e.g. gzip '
+                             'or br), to measure compressed responses')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with an earlier run')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'agency-bench.db')
+
+    from app import create_app
+    from cache import response_cache
+    from bench.fixtures import seed
+    from bench.local_auth import LocalAuth, ROLES
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url})
+    if args.no_cache:
+        response_cache.enabled = False
+    local_auth = LocalAuth()
+    local_auth.install()
+    tokens = {role: local_auth.mint(role) for role in ROLES}
+    if not args.no_seed:
+        started = time.perf_counter()
+        seed(app, args.scale)
+        print(f'seeded {args.scale} actors and movies in '
+              f'{time.perf_counter() - started:.1f}s')
+
+    results = {'meta': {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'database': database_url.split(':', 1)[0],
+        'scale': args.scale,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'cache': not args.no_cache,
+        'accept_encoding': args.accept_encoding,
+        'target': args.url or 'in-process'
+    }}
+    if args.mode in ('load', 'all'):
+        if args.url:
+            # the server must trust the local JWKS: start it with
+            # JWKS_URL pointing at the file printed here
+            print(f'JWKS: {local_auth.jwks_path}')
+            client = HTTPClient(args.url)
+        else:
+            client = TestClient(app)
+        results['load'] = run_load(client, tokens, args)
+    if args.mode in ('micro', 'all'):
+        results['micro'] = run_micro(app, tokens, args)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
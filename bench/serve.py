@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.error import URLError
+
+from bench.run import HTTPClient, print_row, run_scenario, scenarios
+
+"""
+Compares the gunicorn serving profiles (see gunicorn.conf.py) at a fixed
+memory budget.
+
+    python -m bench.serve --memory-mb 512 --db-latency-ms 5
+
+For every profile, one worker is started first to measure its memory use
+(RSS) after warm-up; the profile then gets as many workers as fit into the
+budget, and the load scenarios run over HTTP at every concurrency level.
+Requests go through bench.wsgi, which can add a simulated database round
+trip to every SQL statement, so the benchmark reflects waiting on a remote
+Postgres even when it runs against SQLite.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ServerClient(HTTPClient):
+    # refused and reset connections count as errors instead of aborting
+    def request(self, method, path, headers, body=None):
+        try:
+            return super().request(method, path, headers, body)
+        except (URLError, ConnectionError, socket.timeout):
+            return 599, 0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def worker_pids(master_pid):
+    path = f'/proc/{master_pid}/task/{master_pid}/children'
+    with open(path) as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+'''
+Server
+    a gunicorn process serving bench.wsgi with the given profile
+'''
+
+
+class Server:
+    def __init__(self, profile, workers, args, env):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        env = dict(env, SERVER_PROFILE=profile, WEB_CONCURRENCY=str(workers),
+                   GEVENT_WORKER_CONNECTIONS=str(args.worker_connections))
+        self.process = subprocess.Popen(
+            # gunicorn 20.0 can't be run with -m
+            [sys.executable, '-c',
+             'from gunicorn.app.wsgiapp import run; run()',
+             '-c', 'gunicorn.conf.py',
+             '-b', f'127.0.0.1:{self.port}', '--log-level', 'warning',
+             'bench.wsgi:app'],
+            cwd=ROOT, env=env)
+        self.wait_until_ready(workers)
+
+    def wait_until_ready(self, workers, timeout=30):
+        client = ServerClient(self.url)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and self.process.poll() is None:
+            if client.request('GET', '/login', {})[0] == 200 and \
+                    len(worker_pids(self.process.pid)) == workers:
+                return
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError('gunicorn did not start')
+
+    def rss_mb(self):
+        return sum(rss_mb(pid) for pid in worker_pids(self.process.pid))
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Compare the gunicorn serving profiles at a fixed '
+                    'memory budget.')
+    parser.add_argument('--profiles', default='sync,gevent')
+    parser.add_argument('--memory-mb', type=float, default=512,
+                        help='memory budget of the workers')
+    parser.add_argument('--max-workers', type=int, default=16)
+    parser.add_argument('--worker-connections', type=int, default=100,
+                        help='concurrent requests per gevent worker')
+    parser.add_argument('--db-latency-ms', type=float, default=5,
+                        help='simulated round trip per SQL statement')
+    parser.add_argument('--concurrency', default='8,32,128',
+                        help='comma-separated client concurrency levels')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--scale', type=int, default=1000)
+    parser.add_argument('--database-url')
+    parser.add_argument('--only', default='GET /actors/<id>',
+                        help='only run scenarios containing this')
+    parser.add_argument('--output', help='write the results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'agency-serve-bench.db')
+
+    from app import create_app
+    from bench.fixtures import seed
+    from bench.local_auth import LocalAuth, ROLES
+
+    local_auth = LocalAuth()
+    tokens = {role: local_auth.mint(role) for role in ROLES}
+    seed(create_app({'SQLALCHEMY_DATABASE_URI': database_url}), args.scale)
+    env = dict(os.environ, DATABASE_URL=database_url,
+               JWKS_URL=local_auth.jwks_path, CACHE_ENABLED='false',
+               BENCH_DB_LATENCY_MS=str(args.db_latency_ms))
+    selected = [(name, role, factory) for name, role, factory
+                in scenarios(args.scale, 1) if args.only in name]
+
+    results = {'meta': {
+        'memory_mb': args.memory_mb,
+        'db_latency_ms': args.db_latency_ms,
+        'database': database_url.split(':', 1)[0],
+        'worker_connections': args.worker_connections
+    }, 'profiles': {}}
+    for profile in args.profiles.split(','):
+        server = Server(profile, 1, args, env)
+        for name, role, factory in selected:
+            run_scenario(ServerClient(server.url), tokens, role, factory,
+                         args.warmup * 4, 4, 0)
+        worker_mb = server.rss_mb()
+        server.stop()
+        workers = max(1, min(args.max_workers,
+                             int(args.memory_mb // worker_mb)))
+        print(f'{profile}: {worker_mb:.0f} MB per worker, '
+              f'{workers} workers')
+
+        server = Server(profile, workers, args, env)
+        runs = {}
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            for name, role, factory in selected:
+                result = run_scenario(ServerClient(server.url), tokens,
+                                      role, factory, args.requests,
+                                      concurrency, args.warmup)
+                result['rss_mb'] = server.rss_mb()
+                runs[f'{name} @{concurrency}'] = result
+                print_row(f'{profile} {name} @{concurrency}', result)
+        server.stop()
+        results['profiles'][profile] = {
+            'worker_mb': worker_mb,
+            'workers': workers,
+            'runs': runs
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
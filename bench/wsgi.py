@@ -0,0 +1,25 @@
+import os
+import time
+from sqlalchemy import event
+
+from app import create_app
+from models import db
+
+"""
+The app as served by bench.serve: create_app() plus, if BENCH_DB_LATENCY_MS
+is set, a sleep before every SQL statement that stands in for the network
+round trip to a remote Postgres (time.sleep is cooperative under gevent, as
+psycopg2 is with psycogreen).
+
+    gunicorn bench.wsgi:app
+"""
+
+BENCH_DB_LATENCY_MS = float(os.environ.get('BENCH_DB_LATENCY_MS', 0))
+
+app = create_app()
+
+if BENCH_DB_LATENCY_MS:
+    @event.listens_for(db.get_engine(app), 'before_cursor_execute')
+    def simulate_latency(conn, cursor, statement, parameters, context,
+                         executemany):
+        time.sleep(BENCH_DB_LATENCY_MS / 1000)
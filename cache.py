@@ -0,0 +1,303 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, g, request
+
+from compression import get_compression, set_encoding
+
+# set CACHE_ENABLED=false to turn the response cache off
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'true') == 'true'
+# seconds after which an entry is dropped even if its version is current
+# (bounds staleness across workers for routes without a shared version)
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 30))
+# total and per-entry size limits of the in-process backend
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_MAX_ENTRY_BYTES = int(
+    os.environ.get('CACHE_MAX_ENTRY_BYTES', 8 * 1024 * 1024))
+
+
+'''
+CacheBackend
+    the interface of a cache backend: a key-value store for entries plus one
+    version counter per resource. Implement it to share the cache between
+    workers (e.g. backed by Redis or memcached).
+'''
+
+
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, entry, size, ttl):
+        raise NotImplementedError
+
+    def get_version(self, resource):
+        raise NotImplementedError
+
+    def bump_version(self, resource):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+'''
+InProcessBackend
+    the default backend, an LRU dict bounded by the total size of its
+    entries. Entries and versions are local to the worker process.
+'''
+
+
+class InProcessBackend(CacheBackend):
+    def __init__(self, max_bytes=None, max_entry_bytes=None):
+        self.max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_entry_bytes = (CACHE_MAX_ENTRY_BYTES
+                                if max_entry_bytes is None
+                                else max_entry_bytes)
+        self.bytes = 0
+        self.largest_entry = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            entry, size, expires_at = item
+            if expires_at is not None and time.monotonic() >= expires_at:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, size, ttl):
+        if size > self.max_entry_bytes:
+            return
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (entry, size, expires_at)
+            self.bytes += size
+            self.largest_entry = max(self.largest_entry, size)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_version(self, resource):
+        return self._versions.get(resource, 0)
+
+    def bump_version(self, resource):
+        with self._lock:
+            self._versions[resource] = self._versions.get(resource, 0) + 1
+            # entries of older versions can never be hit again
+            prefix = resource + ':'
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'largest_entry_bytes': self.largest_entry,
+                'evictions': self.evictions
+            }
+
+    def _remove(self, key):
+        entry, size, expires_at = self._entries.pop(key)
+        self.bytes -= size
+
+
+'''
+ResponseCache
+    caches the bodies of GET responses per resource. The cache key contains
+    the resource's current version, which every write to the resource bumps,
+    so entries cached before a write are never served after it.
+'''
+
+
+class ResponseCache:
+    def __init__(self, backend=None, ttl=None, enabled=None):
+        self.backend = backend or InProcessBackend()
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self.enabled = CACHE_ENABLED if enabled is None else enabled
+        self.hits = 0
+        self.misses = 0
+
+    '''
+    make_key(resource, version)
+        the cache key of the current request; uses the backend's version
+        of the resource unless a (shared) version is given
+    '''
+    def make_key(self, resource, version=None):
+        if version is None:
+            version = self.backend.get_version(resource)
+        return f'{resource}:{version}:{request_key()}'
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    '''
+    set(key, body, mimetype, encoded)
+        caches a response body along with its compressed versions, given
+        as {encoding: bytes}
+    '''
+    def set(self, key, body, mimetype, encoded=None):
+        encoded = encoded or {}
+        size = len(body) + sum(len(data) for data in encoded.values())
+        self.backend.set(key, (body, mimetype, encoded), size, self.ttl)
+
+    '''
+    invalidate(resource)
+        bumps the resource's version, to be called after every committed
+        write to the resource
+    '''
+    def invalidate(self, resource):
+        self.backend.bump_version(resource)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+        stats.update(self.backend.stats())
+        return stats
+
+
+response_cache = ResponseCache()
+
+
+def request_key():
+    args = '&'.join(f'{k}={v}' for k, v in
+                    sorted(request.args.items(multi=True)))
+    return f'{request.path}?{args}'
+
+
+'''
+cache_encoding()
+    the encoding the current request accepts, if the app compresses
+    responses (see compression.py), or None
+'''
+
+
+def cache_encoding():
+    compression = get_compression()
+    return compression.negotiate() if compression is not None else None
+
+
+'''
+current_version(resource, version)
+    calls version(resource) at most once per request
+'''
+
+
+def current_version(resource, version):
+    versions = g.setdefault('resource_versions', {})
+    if resource not in versions:
+        versions[resource] = version(resource)
+    return versions[resource]
+
+
+'''
+@cached_response(resource, bypass, version)
+    decorator that serves a route's successful responses from the response
+    cache. Requests for which bypass() returns True are never cached.
+    If given, version(resource) returns a version shared by all workers,
+    which then replaces the backend's per-worker version in the cache key.
+    Must be applied below @requires_auth so permissions are still checked.
+'''
+
+
+def cached_response(resource, bypass=None, version=None):
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not response_cache.enabled or (bypass and bypass()):
+                return f(*args, **kwargs)
+            # the key is computed before the query runs, so a write that
+            # commits in the meantime makes this entry unreachable
+            key = response_cache.make_key(
+                resource,
+                current_version(resource, version) if version else None)
+            encoding = cache_encoding()
+            entry = response_cache.get(key)
+            if entry is not None:
+                body, mimetype, encoded = entry
+                response = Response(body, mimetype=mimetype)
+                if encoding and len(body) >= get_compression().min_bytes:
+                    if encoding not in encoded:
+                        # compressed once, when first requested
+                        encoded = dict(encoded, **{
+                            encoding: get_compression().compress(
+                                body, encoding)})
+                        response_cache.set(key, body, mimetype, encoded)
+                    set_encoding(response, encoding, encoded[encoding])
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = f(*args, **kwargs)
+            if response.status_code == 200 and not response.is_streamed:
+                body = response.get_data()
+                encoded = {}
+                if encoding and len(body) >= get_compression().min_bytes:
+                    encoded[encoding] = get_compression().compress(
+                        body, encoding)
+                    set_encoding(response, encoding, encoded[encoding])
+                response_cache.set(key, body, response.mimetype, encoded)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return cached_response_decorator
+
+
+'''
+@conditional_response(resource, version, bypass)
+    decorator that adds a strong ETag, derived from version(resource) and
+    the request's path and arguments, to a route's successful responses and
+    answers matching If-None-Match requests with 304 Not Modified without
+    calling the route. Requests for which bypass() returns True are passed
+    through unchanged.
+    Must be applied below @requires_auth so permissions are still checked.
+'''
+
+
+def conditional_response(resource, version, bypass=None):
+    def conditional_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if bypass and bypass():
+                return f(*args, **kwargs)
+            # read before the route runs, so a concurrent write can only
+            # make the ETag older than the data, never newer
+            key = f'{resource}:{current_version(resource, version)}:' \
+                f'{request_key()}'
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            response = f(*args, **kwargs)
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return conditional_response_decorator
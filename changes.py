@@ -0,0 +1,413 @@
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+from flask import current_app, has_app_context
+
+from ratelimit import RateLimitError
+
+"""
+Change feed: the inserts, updates and deletes of actors, movies and
+castings, pushed to clients as server-sent events (GET /changes/stream).
+
+Every write path records its changes in the session, and commit_write (see
+models.py) logs them in the Changes table in the write's transaction, each
+with a sequence number from the table's sequence, so concurrent writes
+don't wait for each other. On PostgreSQL, the same transaction sends them
+with pg_notify, and every worker LISTENs on one connection of its own and
+fans them out to its subscribers. Elsewhere (e.g. SQLite in the tests),
+commit_write publishes them to the subscribers of its own worker after
+the commit.
+
+The sequence number is the id of its event, so a client that reconnects
+resumes after the last event it received (the Last-Event-ID header, which
+EventSource sends by itself). Writes may commit in another order than
+their sequence numbers, and a write that rolls back leaves a gap, so a
+stream sends the events in the order of their numbers and stops at a gap
+until the missing events are committed or CHANGES_SETTLE_SECONDS have
+passed since the event after the gap was logged. Events older than the
+last CHANGES_RETAIN are pruned from the log; a client that is further
+behind gets a "reset" event and has to reload the collections.
+
+An open stream holds a connection, but no database connection. With the
+gevent profile (see gunicorn.conf.py), streams stay open, up to
+MAX_CHANGE_SUBSCRIBERS per worker, and wait for events in greenlets. A sync
+worker would be tied up by every stream, so there a response only sends
+the events since Last-Event-ID and ends, and the client reconnects after
+CHANGES_RETRY_MS. CHANGES_STREAM_MODE selects this:
+    auto (default): live if gevent has patched the standard library, poll
+        if not
+    live: streams stay open for up to CHANGES_STREAM_MAX_SECONDS
+    poll: streams end once they have caught up
+"""
+
+CHANGES_ENABLED = os.environ.get('CHANGES_ENABLED', 'true') == 'true'
+CHANGES_STREAM_MODE = os.environ.get('CHANGES_STREAM_MODE', 'auto')
+CHANGES_CHANNEL = 'changes'
+# events kept in the Changes table for clients that reconnect
+CHANGES_RETAIN = int(os.environ.get('CHANGES_RETAIN', 100000))
+# the log is pruned whenever the sequence number crosses a multiple of this
+CHANGES_PRUNE_EVERY = 1000
+# how long a stream waits for the missing events of a gap in the log
+CHANGES_SETTLE_SECONDS = float(os.environ.get('CHANGES_SETTLE_SECONDS', 5))
+# how often a stream reads the log again while it waits at a gap
+CHANGES_GAP_RETRY_SECONDS = 0.1
+MAX_CHANGE_SUBSCRIBERS = int(os.environ.get('MAX_CHANGE_SUBSCRIBERS', 1000))
+CHANGES_HEARTBEAT_SECONDS = float(
+    os.environ.get('CHANGES_HEARTBEAT_SECONDS', 15))
+CHANGES_STREAM_MAX_SECONDS = float(
+    os.environ.get('CHANGES_STREAM_MAX_SECONDS', 300))
+CHANGES_RETRY_MS = int(os.environ.get('CHANGES_RETRY_MS', 2000))
+# notifications queued per subscriber; a subscriber that falls further
+# behind catches up from the log instead
+CHANGES_QUEUE_SIZE = 1000
+# events read from the log per query
+CHANGES_PAGE_SIZE = 1000
+
+RESOURCES = ('actors', 'movies', 'castings')
+OPS = ('insert', 'update', 'delete', 'reload')
+
+# tells a subscriber that it may have missed events
+RESYNC = 'resync'
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Subscription
+    the queue of notifications of one open stream; overflowed is set when
+    it was full and a notification was dropped
+'''
+
+
+class Subscription:
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+        self.overflowed = False
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.overflowed = True
+
+    '''
+    get(timeout)
+        the next list of events (or RESYNC), or None after timeout seconds
+    '''
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self):
+        self.overflowed = False
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+'''
+ChangeFeed
+    the subscribers of a worker, and on PostgreSQL the listener that feeds
+    them the notifications of all workers
+'''
+
+
+class ChangeFeed:
+    def __init__(self, engine, mode=None, max_subscribers=None,
+                 heartbeat=None, max_seconds=None, retry_ms=None,
+                 settle=None):
+        self.engine = engine
+        self.mode = mode or CHANGES_STREAM_MODE
+        if self.mode not in ('auto', 'live', 'poll'):
+            raise ValueError(f'unknown CHANGES_STREAM_MODE: {self.mode}')
+        self.max_subscribers = (MAX_CHANGE_SUBSCRIBERS
+                                if max_subscribers is None
+                                else max_subscribers)
+        self.heartbeat = (CHANGES_HEARTBEAT_SECONDS if heartbeat is None
+                          else heartbeat)
+        self.max_seconds = (CHANGES_STREAM_MAX_SECONDS if max_seconds is None
+                            else max_seconds)
+        self.retry_ms = CHANGES_RETRY_MS if retry_ms is None else retry_ms
+        self.settle = CHANGES_SETTLE_SECONDS if settle is None else settle
+        # on PostgreSQL, every event reaches the subscribers via LISTEN
+        self.listens = engine.dialect.name == 'postgresql'
+        self.subscribers = set()
+        self.events = 0
+        self._listener = None
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    '''
+    live()
+        whether streams stay open (see CHANGES_STREAM_MODE)
+    '''
+    def live(self):
+        if self.mode == 'auto':
+            return cooperative()
+        return self.mode == 'live'
+
+    '''
+    subscribe() / unsubscribe(subscription)
+        add and remove a subscriber; subscribe() raises RateLimitError (503)
+        if the worker already has max_subscribers
+    '''
+    def subscribe(self):
+        with self._lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                full = True
+            else:
+                full = False
+                subscription = Subscription(CHANGES_QUEUE_SIZE)
+                self.subscribers.add(subscription)
+        if full:
+            raise RateLimitError({
+                'code': 'too_many_subscribers',
+                'description': 'Too many open change streams.'
+            }, 503, max(1, self.retry_ms // 1000))
+        if self.listens:
+            self.start_listener()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscribers.discard(subscription)
+
+    '''
+    publish(events)
+        passes a list of committed events to every subscriber
+    '''
+    def publish(self, events):
+        with self._lock:
+            self.events += len(events)
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.put(events)
+
+    def resync(self):
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.put(RESYNC)
+
+    '''
+    start_listener()
+        starts the thread (a greenlet with gevent) that LISTENs for the
+        events of all workers, once per process
+    '''
+    def start_listener(self):
+        with self._lock:
+            if self._listener_pid == os.getpid() and \
+                    self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self.listen,
+                                              name='change-listener',
+                                              daemon=True)
+            self._listener_pid = os.getpid()
+        self._listener.start()
+
+    def listen(self):
+        dialect = self.engine.dialect
+        cargs, cparams = dialect.create_connect_args(self.engine.url)
+        while True:
+            connection = None
+            try:
+                # not from the pool, which would lose it for good
+                connection = dialect.connect(*cargs, **cparams)
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN {CHANGES_CHANNEL}')
+                # events committed before LISTEN are read from the log
+                self.resync()
+                while True:
+                    select.select([connection], [], [], self.heartbeat)
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        self.publish(json.loads(notify.payload))
+            except Exception:
+                logger.exception('change listener failed, reconnecting')
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+            time.sleep(1)
+
+    def stats(self):
+        return {'subscribers': len(self.subscribers), 'events': self.events}
+
+
+'''
+cooperative()
+    True if gevent has patched the standard library, i.e. under the gevent
+    profile, where a waiting stream only costs a greenlet
+'''
+
+
+def cooperative():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+'''
+init_app(app, engine)
+    creates the app's ChangeFeed from its CHANGES_STREAM_MODE,
+    MAX_CHANGE_SUBSCRIBERS, CHANGES_HEARTBEAT_SECONDS,
+    CHANGES_STREAM_MAX_SECONDS, CHANGES_RETRY_MS and CHANGES_SETTLE_SECONDS
+    settings, which take precedence over the environment variables
+'''
+
+
+def init_app(app, engine):
+    feed = ChangeFeed(engine,
+                      app.config.get('CHANGES_STREAM_MODE'),
+                      app.config.get('MAX_CHANGE_SUBSCRIBERS'),
+                      app.config.get('CHANGES_HEARTBEAT_SECONDS'),
+                      app.config.get('CHANGES_STREAM_MAX_SECONDS'),
+                      app.config.get('CHANGES_RETRY_MS'),
+                      app.config.get('CHANGES_SETTLE_SECONDS'))
+    app.extensions['changes'] = feed
+    return feed
+
+
+def get_feed():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('changes')
+
+
+'''
+publish_committed(events)
+    called by commit_write with the events of a committed write; delivers
+    them to the subscribers of this worker, unless the listener does
+'''
+
+
+def publish_committed(events):
+    feed = get_feed()
+    if events and feed is not None and not feed.listens:
+        feed.publish(events)
+
+
+'''
+format_event(name, data, seq)
+    a server-sent event, with seq as its id
+'''
+
+
+def format_event(name, data, seq):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (
+        seq, name, json.dumps(data, sort_keys=True))
+
+
+'''
+stream_events(feed, subscription, after, resources)
+    generator of the server-sent events of a stream: the events after the
+    sequence number "after" (from the log), or a "ready" event with the
+    watermark of the log (see Change.watermark) and the events after it if
+    "after" is None, then in live mode (with a subscription) the new events
+    as they are committed, with a heartbeat comment every heartbeat
+    seconds, for up to max_seconds
+'''
+
+
+def stream_events(feed, subscription, after, resources):
+    # imported here because models imports this module
+    from models import Change, db
+
+    def catch_up(last):
+        settled = time.time() - feed.settle
+        latest = Change.latest()
+        oldest = Change.oldest()
+        if last > latest or last < (latest if oldest is None
+                                    else oldest - 1):
+            # the client missed events that are no longer in the log
+            seq = Change.watermark(settled)
+            yield format_event('reset', {'seq': seq}, seq), seq
+            return
+        while True:
+            events = Change.since(last, CHANGES_PAGE_SIZE)
+            for event in events:
+                if event.pop('logged_at') > settled and \
+                        event['seq'] > last + 1:
+                    # the missing events may not be committed yet
+                    yield None, last
+                    return
+                if event['resource'] in resources:
+                    yield format_event('change', event, event['seq']), \
+                        event['seq']
+                last = event['seq']
+            if len(events) < CHANGES_PAGE_SIZE:
+                return
+
+    '''
+    read_log(last)
+        the events after last from the log, the sequence number of the last
+        of them, and whether the log has a gap that may yet be filled
+    '''
+    def read_log(last):
+        chunk = []
+        waiting = False
+        for message, last in catch_up(last):
+            if message is None:
+                waiting = True
+            else:
+                chunk.append(message)
+        # the stream doesn't hold on to a database connection
+        db.session.close()
+        return ''.join(chunk), last, waiting
+
+    yield 'retry: %d\n\n' % feed.retry_ms
+    if after is None:
+        after = Change.watermark(time.time() - feed.settle)
+        db.session.close()
+        yield format_event('ready', {'seq': after}, after)
+    messages, last, waiting = read_log(after)
+    if messages:
+        yield messages
+    if subscription is None:
+        return
+    deadline = time.monotonic() + feed.max_seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        timeout = min(feed.heartbeat, remaining)
+        if waiting:
+            timeout = min(timeout, CHANGES_GAP_RETRY_SECONDS)
+        item = subscription.get(timeout)
+        if item is None and not waiting:
+            yield ': heartbeat\n\n'
+            continue
+        if subscription.overflowed:
+            subscription.drain()
+            item = RESYNC
+        messages = []
+        if item is not None and item != RESYNC and not waiting:
+            for event in item:
+                if event['seq'] <= last:
+                    continue
+                if event['seq'] > last + 1:
+                    # e.g. two commits published out of order
+                    item = RESYNC
+                    break
+                if event['resource'] in resources:
+                    messages.append(
+                        format_event('change', event, event['seq']))
+                last = event['seq']
+        if item is None or item == RESYNC or waiting:
+            log_messages, last, waiting = read_log(last)
+            messages.append(log_messages)
+        if any(messages):
+            yield ''.join(messages)
@@ -0,0 +1,211 @@
+import os
+import zlib
+from flask import current_app, has_app_context, request
+
+from metrics import registry, timer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+Response compression.
+
+Responses of at least COMPRESS_MIN_BYTES are compressed with brotli or gzip,
+whichever the client's Accept-Encoding header prefers (brotli on a tie, if
+the brotli module is installed). Streamed exports are compressed chunk by
+chunk. GZIP_LEVEL (1 to 9) and BROTLI_QUALITY (0 to 11) trade CPU time for
+bandwidth; above the defaults, responses get only slightly smaller but take
+a lot longer to compress. The ETag of a compressed response is made weak,
+as its bytes differ from those of the uncompressed representation;
+If-None-Match still matches it.
+
+The response cache keeps the compressed bodies with its entries (see
+cache.py), so hot responses are compressed once per encoding.
+"""
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true') == 'true'
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+COMPRESS_MIMETYPES = {'application/json', 'application/x-ndjson',
+                      'text/html', 'text/plain'}
+
+
+'''
+GzipStream / BrotliStream
+    compress a stream chunk by chunk: compress(chunk) returns everything
+    the client needs to decode the chunk, finish() the end of the stream
+'''
+
+
+class GzipStream:
+    def __init__(self, level):
+        # wbits 31: a gzip header and trailer (with an mtime of 0)
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        return (self.compressor.compress(chunk) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliStream:
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, chunk):
+        return self.compressor.process(chunk) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+'''
+Compression
+    the compression settings of an app
+'''
+
+
+class Compression:
+    def __init__(self, enabled=None, min_bytes=None, gzip_level=None,
+                 brotli_quality=None):
+        self.enabled = COMPRESSION_ENABLED if enabled is None else enabled
+        self.min_bytes = COMPRESS_MIN_BYTES if min_bytes is None \
+            else min_bytes
+        self.gzip_level = GZIP_LEVEL if gzip_level is None else gzip_level
+        self.brotli_quality = (BROTLI_QUALITY if brotli_quality is None
+                               else brotli_quality)
+        # in order of preference
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    '''
+    negotiate()
+        the encoding the current request accepts with the highest quality,
+        or None
+    '''
+    def negotiate(self):
+        if not self.enabled:
+            return None
+        accepted = request.accept_encodings
+        best = None
+        for encoding in self.encodings:
+            quality = accepted[encoding]
+            if quality > 0 and (best is None or quality > best[1]):
+                best = (encoding, quality)
+        return best[0] if best else None
+
+    '''
+    compress(body, encoding)
+        the body compressed with the encoding ("br" or "gzip")
+    '''
+    def compress(self, body, encoding):
+        with timer('compress_duration_seconds', encoding=encoding):
+            if encoding == 'br':
+                compressed = brotli.compress(body,
+                                             quality=self.brotli_quality)
+            else:
+                compressor = zlib.compressobj(self.gzip_level,
+                                              zlib.DEFLATED, 31)
+                compressed = compressor.compress(body) + compressor.flush()
+        count_bytes(encoding, len(body), len(compressed))
+        return compressed
+
+    '''
+    compress_stream(chunks, encoding)
+        generator that compresses the chunks of a streamed response
+    '''
+    def compress_stream(self, chunks, encoding):
+        if encoding == 'br':
+            stream = BrotliStream(self.brotli_quality)
+        else:
+            stream = GzipStream(self.gzip_level)
+        for chunk in chunks:
+            compressed = stream.compress(chunk)
+            count_bytes(encoding, len(chunk), len(compressed))
+            if compressed:
+                yield compressed
+        compressed = stream.finish()
+        count_bytes(encoding, 0, len(compressed))
+        yield compressed
+
+    def compressible(self, response):
+        return response.mimetype in COMPRESS_MIMETYPES and \
+            200 <= response.status_code < 300 and \
+            response.status_code != 204
+
+
+def count_bytes(encoding, size, compressed_size):
+    registry.inc('compression_input_bytes_total', size, encoding=encoding)
+    registry.inc('compression_output_bytes_total', compressed_size,
+                 encoding=encoding)
+
+
+def get_compression():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('compression')
+
+
+'''
+set_encoding(response, encoding, body)
+    marks response as encoded with the encoding, with body as its (already
+    compressed) bytes
+'''
+
+
+def set_encoding(response, encoding, body):
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+
+
+'''
+init_app(app)
+    creates the app's Compression from its COMPRESSION_ENABLED,
+    COMPRESS_MIN_BYTES, GZIP_LEVEL and BROTLI_QUALITY settings, which take
+    precedence over the environment variables, and registers the hook that
+    compresses the responses
+'''
+
+
+def init_app(app):
+    compression = Compression(app.config.get('COMPRESSION_ENABLED'),
+                              app.config.get('COMPRESS_MIN_BYTES'),
+                              app.config.get('GZIP_LEVEL'),
+                              app.config.get('BROTLI_QUALITY'))
+    app.extensions['compression'] = compression
+
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESS_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = compression.negotiate()
+        if encoding is None:
+            return response
+        # the same ETag for the 200 and 304 responses of a request
+        if response.get_etag()[0]:
+            response.set_etag(response.get_etag()[0], weak=True)
+        if 'Content-Encoding' in response.headers or \
+                not compression.compressible(response):
+            return response
+        if response.is_streamed:
+            original = response.response
+            response.response = compression.compress_stream(
+                response.iter_encoded(), encoding)
+            # e.g. pops the request context of stream_with_context
+            if hasattr(original, 'close'):
+                response.call_on_close(original.close)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoding
+        elif len(response.get_data()) >= compression.min_bytes:
+            set_encoding(response, encoding,
+                         compression.compress(response.get_data(),
+                                              encoding))
+        return response
+
+    return compression
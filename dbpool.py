@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+"""
+Engine and connection pool configuration, read from environment variables.
+
+Every gunicorn worker has its own pool, so the database sees up to
+    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+connections. Keep that below Postgres' max_connections, or use an external
+pooler (e.g. PgBouncer) with DB_EXTERNAL_POOLER=true.
+"""
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# seconds to wait for a connection before giving up
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+# seconds after which a connection is replaced, -1 to keep it forever
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', -1))
+# test connections with a round trip on checkout
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'false') == 'true'
+# milliseconds after which Postgres cancels a statement, 0 to disable
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+# don't pool connections in the app (NullPool) because an external pooler
+# does; the statement timeout is then set per transaction with SET LOCAL,
+# since transaction-mode poolers don't support session settings
+DB_EXTERNAL_POOLER = os.environ.get('DB_EXTERNAL_POOLER', 'false') == 'true'
+
+
+'''
+PoolStats
+    checkout counters shared by all pools of the worker process
+'''
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+
+pool_stats = PoolStats()
+
+
+'''
+InstrumentedQueuePool
+    a QueuePool that records how long each checkout waited for a connection
+'''
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record_wait(time.perf_counter() - start, True)
+            raise
+        pool_stats.record_wait(time.perf_counter() - start)
+        return connection
+
+
+'''
+engine_options(database_path)
+    the SQLALCHEMY_ENGINE_OPTIONS for the given database URL
+'''
+
+
+def engine_options(database_path):
+    if database_path.startswith('sqlite'):
+        # sqlite uses its own pool classes, which take none of the options
+        return {}
+    options = {'pool_pre_ping': DB_POOL_PRE_PING}
+    if DB_EXTERNAL_POOLER:
+        options['poolclass'] = NullPool
+        return options
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE
+    })
+    if DB_STATEMENT_TIMEOUT:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+        }
+    return options
+
+
+'''
+configure_engine(engine)
+    registers the event listeners that make the engine safe to use after a
+    fork and apply the statement timeout in external pooler mode
+'''
+
+
+def configure_engine(engine):
+    # connections opened before a fork (e.g. with gunicorn --preload) must
+    # not be shared with the parent, so the child discards them on checkout
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection belongs to pid %s, attempting to check out in '
+                'pid %s' % (connection_record.info['pid'], os.getpid()))
+
+    if DB_EXTERNAL_POOLER and DB_STATEMENT_TIMEOUT and \
+            engine.dialect.name == 'postgresql':
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.execute(
+                f'SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT}')
+
+
+'''
+pool_metrics(engine)
+    the current pool usage of the engine and the checkout counters
+'''
+
+
+def pool_metrics(engine):
+    pool = engine.pool
+    metrics = {
+        'checkouts': pool_stats.checkouts,
+        'checkout_timeouts': pool_stats.timeouts,
+        'checkout_wait_seconds_total': pool_stats.wait_seconds_total,
+        'checkout_wait_seconds_max': pool_stats.wait_seconds_max
+    }
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        metrics.update({
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'saturation': pool.checkedout() / capacity if capacity else 0.0
+        })
+    return metrics
@@ -0,0 +1,40 @@
+import os
+
+"""
+gunicorn settings (gunicorn reads this file from the working directory).
+
+SERVER_PROFILE selects how requests are served:
+    sync (default): one request at a time per worker process. Concurrency is
+        the number of workers, each of which blocks while it waits on
+        Postgres or Auth0.
+    gevent: every worker serves up to GEVENT_WORKER_CONNECTIONS requests
+        concurrently in greenlets, switching between them while they wait on
+        the network. psycopg2 is made cooperative with psycogreen, and the
+        standard library (sockets, threads, locks, sleep) by gevent's monkey
+        patching, so the JWKS client and the connection pool cooperate too.
+        Size the pool for it: DB_POOL_SIZE + DB_MAX_OVERFLOW connections are
+        shared by all greenlets of a worker; the others wait for one up to
+        DB_POOL_TIMEOUT seconds.
+"""
+
+SERVER_PROFILE = os.environ.get('SERVER_PROFILE', 'sync')
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+if SERVER_PROFILE == 'gevent':
+    worker_class = 'gevent'
+    worker_connections = int(
+        os.environ.get('GEVENT_WORKER_CONNECTIONS', 100))
+
+    def post_fork(server, worker):
+        # wait for Postgres on gevent's hub instead of blocking the process
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+elif SERVER_PROFILE != 'sync':
+    raise ValueError(f'unknown SERVER_PROFILE: {SERVER_PROFILE}')
+
+
+def child_exit(server, worker):
+    # drop the exited worker's metrics from the totals (see metrics.py)
+    from metrics import remove_snapshot
+    remove_snapshot(worker.pid)
@@ -1,13 +1,115 @@
-from flask_script import Manager
+import sys
+import time
+from flask_script import Command, Manager, Option
 from flask_migrate import Migrate, MigrateCommand
+from sqlalchemy.exc import IntegrityError
 
-from app import app
-from models import db
+from app import create_app, validate_actor, validate_movie
+from models import db, Actor, Movie, Stats
+import transfer
+
+app = create_app()
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
+
+class RebuildStats(Command):
+    """Recomputes the Stats summary table from Actors and Movies"""
+
+    def run(self):
+        Stats.rebuild()
+
+
+RESOURCES = {
+    'actors': (Actor, validate_actor),
+    'movies': (Movie, validate_movie)
+}
+
+
+def report(message, final=False):
+    # progress goes to stderr, so exports can be written to stdout
+    sys.stderr.write('\r' + message.ljust(79) + ('\n' if final else ''))
+    sys.stderr.flush()
+
+
+class Import(Command):
+    """Imports actors or movies from a CSV or NDJSON file ("-" for stdin)
+
+    Rows whose name/title exists update it (--on-conflict update), are
+    skipped (skip) or fail the import (error). See transfer.py.
+    """
+
+    option_list = (
+        Option('resource', choices=sorted(RESOURCES)),
+        Option('path'),
+        Option('--format', dest='fmt', choices=transfer.FORMATS),
+        Option('--on-conflict', dest='on_conflict',
+               choices=transfer.ON_CONFLICT, default='update'),
+        Option('--chunk-size', dest='chunk_size', type=int)
+    )
+
+    def run(self, resource, path, fmt, on_conflict, chunk_size):
+        model, validate = RESOURCES[resource]
+        try:
+            fmt = transfer.file_format(path, fmt)
+        except ValueError as e:
+            sys.exit(str(e))
+        started = time.perf_counter()
+
+        def progress(result):
+            report(f'{resource}: {result.read} read, {result.inserted} '
+                   f'inserted, {result.updated} updated '
+                   f'({time.perf_counter() - started:.1f}s)')
+
+        with transfer.open_file(path, 'r') as f:
+            try:
+                result = transfer.import_items(
+                    model, transfer.read_items(f, fmt), validate,
+                    on_conflict, chunk_size, progress)
+            except IntegrityError:
+                report(f'{resource}: import failed, a {model.UNIQUE_FIELD} '
+                       f'already exists (nothing was imported)', final=True)
+                sys.exit(1)
+        stats = result.stats()
+        report(f'{resource}: ' +
+               ', '.join(f'{count} {name}' for name, count in stats.items())
+               + f' in {time.perf_counter() - started:.1f}s', final=True)
+        for error in result.errors:
+            sys.stderr.write(f'  {error}\n')
+
+
+class Export(Command):
+    """Exports all actors or movies as CSV or NDJSON ("-" for stdout)"""
+
+    option_list = (
+        Option('resource', choices=sorted(RESOURCES)),
+        Option('path'),
+        Option('--format', dest='fmt', choices=transfer.FORMATS)
+    )
+
+    def run(self, resource, path, fmt):
+        model, validate = RESOURCES[resource]
+        try:
+            fmt = transfer.file_format(path, fmt)
+        except ValueError as e:
+            sys.exit(str(e))
+        started = time.perf_counter()
+
+        def progress(count):
+            report(f'{resource}: {count} exported '
+                   f'({time.perf_counter() - started:.1f}s)')
+
+        with transfer.open_file(path, 'w') as f:
+            count = transfer.export_items(model, f, fmt, progress)
+        report(f'{resource}: {"all" if count is None else count} exported '
+               f'in {time.perf_counter() - started:.1f}s', final=True)
+
+
 manager.add_command('db', MigrateCommand)
+manager.add_command('rebuild_stats', RebuildStats())
+manager.add_command('import', Import())
+manager.add_command('export', Export())
 
 
 if __name__ == '__main__':
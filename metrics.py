@@ -0,0 +1,432 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+"""
+Request timing instrumentation and a Prometheus text exposition of it.
+
+Every worker keeps its metrics in memory. If METRICS_DIR is set, each worker
+also writes a snapshot of them to METRICS_DIR/<pid>.json (at most every
+METRICS_FLUSH_INTERVAL seconds), and /metrics sums the snapshots of all
+workers, so it reports the same totals whichever worker serves the scrape.
+Point METRICS_DIR at an empty directory that is cleared on deploy. Only
+the snapshots of live workers are summed: a worker's snapshot is removed
+when it exits (by gunicorn's child_exit hook, see gunicorn.conf.py), or
+else by the next scrape that finds its pid gone. Gauges thus report e.g.
+the connections in use by the running workers, and counters drop the
+counts of exited workers, which Prometheus treats as a counter reset.
+"""
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+# share of requests (0 to 1) that get a Server-Timing response header
+SERVER_TIMING_SAMPLE_RATE = float(
+    os.environ.get('SERVER_TIMING_SAMPLE_RATE', 0))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+'''
+Registry
+    the metrics of one worker: counters and histograms, each with samples
+    keyed by their label values
+'''
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+
+    def counter(self, name, help):
+        self.metrics[name] = {'type': 'counter', 'help': help,
+                              'samples': {}}
+
+    def gauge(self, name, help):
+        self.metrics[name] = {'type': 'gauge', 'help': help, 'samples': {}}
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.metrics[name] = {'type': 'histogram', 'help': help,
+                              'buckets': list(buckets), 'samples': {}}
+
+    def inc(self, name, value=1, **labels):
+        key = label_key(labels)
+        with self._lock:
+            samples = self.metrics[name]['samples']
+            samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = label_key(labels)
+        with self._lock:
+            metric = self.metrics[name]
+            sample = metric['samples'].get(key)
+            if sample is None:
+                # one count per bucket, then the sum and the total count
+                sample = [0] * (len(metric['buckets']) + 2)
+                metric['samples'][key] = sample
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    sample[i] += 1
+            sample[-2] += value
+            sample[-1] += 1
+
+    '''
+    collector(f)
+        registers f, which returns (name, labels, value) tuples of counters
+        and gauges kept elsewhere (e.g. the cache statistics); they are
+        copied into the registry whenever it is snapshotted. Registering a
+        function of the same name again replaces it.
+    '''
+    def collector(self, f):
+        self.collectors[f.__name__] = f
+        return f
+
+    def snapshot(self):
+        for collect in list(self.collectors.values()):
+            for name, labels, value in collect():
+                with self._lock:
+                    self.metrics[name]['samples'][label_key(labels)] = value
+        with self._lock:
+            return json.loads(json.dumps(self.metrics))
+
+    '''
+    flush(force)
+        writes this worker's snapshot to METRICS_DIR
+    '''
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not METRICS_DIR:
+            return
+        if not force and now - self._last_flush < METRICS_FLUSH_INTERVAL:
+            return
+        self._last_flush = now
+        fd, path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path, os.path.join(METRICS_DIR, f'{os.getpid()}.json'))
+
+    '''
+    collect()
+        the metrics of all live workers, summed; removes the snapshots of
+        workers that are gone
+    '''
+    def collect(self):
+        if not METRICS_DIR:
+            return self.snapshot()
+        self.flush(force=True)
+        merged = {}
+        for filename in os.listdir(METRICS_DIR):
+            pid, extension = os.path.splitext(filename)
+            if extension != '.json' or not pid.isdigit():
+                continue
+            if not pid_alive(int(pid)):
+                remove_snapshot(int(pid))
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            merge(merged, snapshot)
+        return merged
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+'''
+remove_snapshot(pid)
+    removes the snapshot of a worker that exited, e.g. from gunicorn's
+    child_exit hook
+'''
+
+
+def remove_snapshot(pid):
+    if not METRICS_DIR:
+        return
+    try:
+        os.remove(os.path.join(METRICS_DIR, f'{pid}.json'))
+    except FileNotFoundError:
+        pass
+
+
+def label_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def merge(merged, snapshot):
+    for name, metric in snapshot.items():
+        target = merged.setdefault(name, dict(metric, samples={}))
+        for key, value in metric['samples'].items():
+            if key not in target['samples']:
+                target['samples'][key] = value
+            elif metric['type'] != 'histogram':
+                target['samples'][key] += value
+            else:
+                target['samples'][key] = [
+                    a + b for a, b in zip(target['samples'][key], value)]
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+'''
+render(metrics)
+    the Prometheus text exposition format of a snapshot
+'''
+
+
+def render(metrics):
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for key, value in sorted(metric['samples'].items()):
+            labels = [tuple(pair) for pair in json.loads(key)]
+            if metric['type'] != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            for bound, count in zip(metric['buckets'], value):
+                lines.append(f'{name}_bucket'
+                             f'{format_labels(labels, [("le", bound)])} '
+                             f'{count}')
+            lines.append(f'{name}_bucket'
+                         f'{format_labels(labels, [("le", "+Inf")])} '
+                         f'{value[-1]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+registry.histogram('http_request_duration_seconds',
+                   'Time spent handling a request.')
+registry.histogram('auth_phase_duration_seconds',
+                   'Time spent in each phase of requires_auth.')
+registry.histogram('db_queries_per_request',
+                   'Number of SQL statements executed per request.',
+                   COUNT_BUCKETS)
+registry.histogram('db_query_duration_seconds',
+                   'Time spent executing a single SQL statement.')
+registry.histogram('db_request_duration_seconds',
+                   'Time spent executing SQL statements per request.')
+registry.histogram('serialize_duration_seconds',
+                   'Time spent serializing a JSON response.')
+registry.histogram('compress_duration_seconds',
+                   'Time spent compressing a response body.')
+registry.counter('compression_input_bytes_total',
+                 'Bytes of response bodies before compression.')
+registry.counter('compression_output_bytes_total',
+                 'Bytes of response bodies after compression.')
+registry.counter('token_cache_lookups_total',
+                 'Verified token cache lookups by result.')
+registry.counter('response_cache_lookups_total',
+                 'Response cache lookups by result.')
+registry.gauge('response_cache_bytes',
+               'Size of the response cache entries.')
+registry.counter('db_pool_checkouts_total',
+                 'Connection pool checkouts.')
+registry.counter('db_pool_checkout_timeouts_total',
+                 'Connection pool checkouts that timed out.')
+registry.counter('db_pool_checkout_wait_seconds_total',
+                 'Time spent waiting for a pooled connection.')
+registry.gauge('db_pool_checked_out',
+               'Connections currently checked out of the pool.')
+registry.gauge('db_pool_capacity',
+               'Connections the pool may open (size plus overflow).')
+registry.counter('db_reads_total',
+                 'Read-only requests by the database they read from.')
+registry.counter('db_replica_failovers_total',
+                 'Read-only requests retried on the primary.')
+registry.gauge('db_replicas_healthy',
+               'Replicas that passed their last health check.')
+registry.counter('requests_shed_total',
+                 'Requests rejected by a rate limit or the concurrency cap.')
+registry.gauge('requests_in_flight',
+               'API requests currently counted against the concurrency cap.')
+registry.gauge('change_stream_subscribers',
+               'Open change streams waiting for events.')
+registry.counter('change_events_total',
+                 'Change events delivered to the change streams.')
+
+
+# ---------------------------------------------------------------------------#
+# Per-request timings
+# ---------------------------------------------------------------------------#
+
+def request_timings():
+    if not has_request_context():
+        return None
+    if 'timings' not in g:
+        g.timings = {}
+    return g.timings
+
+
+'''
+record(phase, seconds)
+    adds a duration to the current request's timings (for Server-Timing)
+'''
+
+
+def record(phase, seconds):
+    timings = request_timings()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+'''
+timer(metric, **labels)
+    context manager that observes the duration of its block in the given
+    histogram and adds it to the request's timings under the metric's
+    "phase" label (or the metric name)
+'''
+
+
+@contextmanager
+def timer(metric, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        registry.observe(metric, seconds, **labels)
+        record(labels.get('phase', metric.replace('_duration_seconds', '')),
+               seconds)
+
+
+# ---------------------------------------------------------------------------#
+# Flask and SQLAlchemy hooks
+# ---------------------------------------------------------------------------#
+
+'''
+instrument_engine(engine)
+    counts and times every SQL statement executed during a request
+'''
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        # kept on the statement's context, so a statement that raises
+        # leaves nothing behind to skew the next one
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        seconds = time.perf_counter() - context._query_start
+        registry.observe('db_query_duration_seconds', seconds)
+        if has_request_context():
+            g.db_queries = g.get('db_queries', 0) + 1
+            record('db', seconds)
+
+
+'''
+init_app(app, engine)
+    registers the request hooks that time every request and add the
+    Server-Timing header to sampled ones
+'''
+
+
+def init_app(app, engine):
+    # imported here because auth imports this module
+    from auth import token_cache
+    from cache import response_cache
+    from dbpool import pool_metrics
+
+    instrument_engine(engine)
+
+    @registry.collector
+    def collect_stats():
+        tokens = token_cache.stats()
+        responses = response_cache.stats()
+        pool = pool_metrics(engine)
+        yield 'token_cache_lookups_total', {'result': 'hit'}, tokens['hits']
+        yield 'token_cache_lookups_total', {'result': 'miss'}, \
+            tokens['misses']
+        yield 'response_cache_lookups_total', {'result': 'hit'}, \
+            responses['hits']
+        yield 'response_cache_lookups_total', {'result': 'miss'}, \
+            responses['misses']
+        yield 'response_cache_bytes', {}, responses.get('bytes', 0)
+        yield 'db_pool_checkouts_total', {}, pool['checkouts']
+        yield 'db_pool_checkout_timeouts_total', {}, \
+            pool['checkout_timeouts']
+        yield 'db_pool_checkout_wait_seconds_total', {}, \
+            pool['checkout_wait_seconds_total']
+        if 'size' in pool:
+            yield 'db_pool_checked_out', {}, pool['checked_out']
+            yield 'db_pool_capacity', {}, \
+                pool['size'] + max(pool['max_overflow'], 0)
+        replica_set = app.extensions.get('replicas')
+        if replica_set is not None and replica_set.replicas:
+            replicas = replica_set.stats()
+            yield 'db_reads_total', {'target': 'replica'}, \
+                replicas['replica_reads']
+            yield 'db_reads_total', {'target': 'primary'}, \
+                replicas['primary_reads']
+            yield 'db_replica_failovers_total', {}, replicas['failovers']
+            yield 'db_replicas_healthy', {}, replicas['healthy']
+        limiter = app.extensions.get('rate_limiter')
+        if limiter is not None:
+            for (reason, permission), count in list(limiter.shed.items()):
+                yield 'requests_shed_total', \
+                    {'reason': reason, 'permission': permission}, count
+            yield 'requests_in_flight', {}, limiter.in_flight
+        feed = app.extensions.get('changes')
+        if feed is not None:
+            feed_stats = feed.stats()
+            yield 'change_stream_subscribers', {}, feed_stats['subscribers']
+            yield 'change_events_total', {}, feed_stats['events']
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.server_timing = random.random() < SERVER_TIMING_SAMPLE_RATE
+
+    @app.after_request
+    def stop_timer(response):
+        if 'request_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.request_start
+        endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+        registry.observe('http_request_duration_seconds', seconds,
+                         method=request.method, endpoint=endpoint,
+                         status=response.status_code)
+        timings = request_timings()
+        queries = g.get('db_queries', 0)
+        registry.observe('db_queries_per_request', queries,
+                         endpoint=endpoint)
+        registry.observe('db_request_duration_seconds',
+                         timings.get('db', 0.0), endpoint=endpoint)
+        if g.server_timing:
+            entries = ['%s;dur=%.3f' % (name, value * 1000)
+                       for name, value in timings.items()]
+            entries.append('total;dur=%.3f' % (seconds * 1000))
+            entries.append('db-queries;desc="%d"' % queries)
+            response.headers['Server-Timing'] = ', '.join(entries)
+        registry.flush()
+        return response
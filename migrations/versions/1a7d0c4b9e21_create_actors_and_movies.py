@@ -0,0 +1,44 @@
+"""create Actors and Movies
+
+Revision ID: 1a7d0c4b9e21
+Revises: 
+Create Date: 2026-10-18 15:52:37.204815
+
+Inserted before 5b99d7ec8b3d, the original first revision, whose
+down_revision now points here; databases already stamped at 5b99d7ec8b3d
+or later never run it.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a7d0c4b9e21'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Actors',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('age', sa.Integer(), nullable=True),
+    sa.Column('gender', sa.Enum('female', 'male', 'other', name='gender'), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('Movies',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(), nullable=False),
+    sa.Column('release_date', sa.Date(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('title')
+    )
+
+
+def downgrade():
+    op.drop_table('Movies')
+    op.drop_table('Actors')
+    sa.Enum(name='gender').drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,32 @@
+"""add TableVersions
+
+Revision ID: 3f2a9c1d7e45
+Revises: 5b99d7ec8b3d
+Create Date: 2026-10-18 16:05:12.418230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7e45'
+down_revision = '5b99d7ec8b3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('TableVersions',
+    sa.Column('resource', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('resource')
+    )
+    op.bulk_insert(table_versions, [
+        {'resource': 'Actors', 'version': 0},
+        {'resource': 'Movies', 'version': 0}
+    ])
+
+
+def downgrade():
+    op.drop_table('TableVersions')
@@ -1,7 +1,7 @@
 """empty message
 
 Revision ID: 5b99d7ec8b3d
-Revises: 
+Revises: 1a7d0c4b9e21
 Create Date: 2020-12-02 11:30:40.058619
 
 """
@@ -11,14 +11,15 @@ import sqlalchemy as sa
 
 # revision identifiers, used by Alembic.
 revision = '5b99d7ec8b3d'
-down_revision = None
+down_revision = '1a7d0c4b9e21'
 branch_labels = None
 depends_on = None
 
 
 def upgrade():
     # ### commands auto generated by Alembic - please adjust! ###
-    op.drop_table('People')
+    # the table only exists in databases created before the first migration
+    op.execute('DROP TABLE IF EXISTS "People"')
     # ### end Alembic commands ###
 
 
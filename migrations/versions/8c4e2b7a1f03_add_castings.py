@@ -0,0 +1,33 @@
+"""add Castings
+
+Revision ID: 8c4e2b7a1f03
+Revises: 3f2a9c1d7e45
+Create Date: 2026-10-18 18:42:37.106514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e2b7a1f03'
+down_revision = '3f2a9c1d7e45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Castings',
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['Actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['Movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('actor_id', 'movie_id')
+    )
+    op.create_index('ix_Castings_movie_id', 'Castings', ['movie_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Castings_movie_id', table_name='Castings')
+    op.drop_table('Castings')
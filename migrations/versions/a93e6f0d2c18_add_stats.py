@@ -0,0 +1,62 @@
+"""add Stats
+
+Revision ID: a93e6f0d2c18
+Revises: d5f81c3a9b62
+Create Date: 2026-10-18 20:14:51.302967
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a93e6f0d2c18'
+down_revision = 'd5f81c3a9b62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    stats = op.create_table('Stats',
+    sa.Column('resource', sa.String(), nullable=False),
+    sa.Column('dimension', sa.String(), nullable=False),
+    sa.Column('bucket', sa.String(), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('resource', 'dimension', 'bucket')
+    )
+    # fill in the counts of the existing rows; from now on, the app keeps
+    # them up to date
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        year = "strftime('%Y', release_date)"
+    else:
+        year = "CAST(EXTRACT(YEAR FROM release_date) AS INTEGER)"
+    queries = [
+        ('actors', 'by_gender', 'gender', 'Actors'),
+        ('actors', 'by_age', 'age / 10 * 10', 'Actors'),
+        ('movies', 'by_release_year', year, 'Movies')
+    ]
+    rows = []
+    for resource, table in (('actors', 'Actors'), ('movies', 'Movies')):
+        count = bind.execute(f'SELECT count(*) FROM "{table}"').scalar()
+        rows.append({'resource': resource, 'dimension': 'total',
+                     'bucket': '', 'count': count})
+    for resource, dimension, expression, table in queries:
+        result = bind.execute(
+            f'SELECT {expression}, count(*) FROM "{table}" '
+            f'GROUP BY {expression}')
+        for value, count in result:
+            if value is None:
+                bucket = 'unknown'
+            elif dimension == 'by_age':
+                low = max(int(value), 0)
+                bucket = f'{low}-{low + 9}'
+            else:
+                bucket = str(value)
+            rows.append({'resource': resource, 'dimension': dimension,
+                         'bucket': bucket, 'count': count})
+    op.bulk_insert(stats, rows)
+
+
+def downgrade():
+    op.drop_table('Stats')
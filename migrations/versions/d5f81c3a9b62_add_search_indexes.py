@@ -0,0 +1,36 @@
+"""add trigram search indexes
+
+Revision ID: d5f81c3a9b62
+Revises: 8c4e2b7a1f03
+Create Date: 2026-10-18 19:27:04.551830
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5f81c3a9b62'
+down_revision = '8c4e2b7a1f03'
+branch_labels = None
+depends_on = None
+
+
+# pg_trgm only exists on PostgreSQL; other databases are searched with the
+# in-process index in search.py
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_Actors_name_trgm', 'Actors', ['name'],
+                    postgresql_using='gin',
+                    postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_Movies_title_trgm', 'Movies', ['title'],
+                    postgresql_using='gin',
+                    postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_Movies_title_trgm', table_name='Movies')
+    op.drop_index('ix_Actors_name_trgm', table_name='Actors')
@@ -0,0 +1,33 @@
+"""add Changes
+
+Revision ID: e27b4f9c3a51
+Revises: a93e6f0d2c18
+Create Date: 2026-10-18 23:12:40.681559
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e27b4f9c3a51'
+down_revision = 'a93e6f0d2c18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Changes',
+    sa.Column('seq', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+              autoincrement=True, nullable=False),
+    sa.Column('resource', sa.String(), nullable=False),
+    sa.Column('op', sa.String(), nullable=False),
+    sa.Column('ids', sa.String(), nullable=False),
+    sa.Column('logged_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+
+
+def downgrade():
+    op.drop_table('Changes')
@@ -1,31 +1,550 @@
-from sqlalchemy import Column, String, Integer, create_engine, Enum, Date
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    Column,
+    String,
+    Integer,
+    BigInteger,
+    ForeignKey,
+    Index,
+    and_,
+    cast,
+    Enum,
+    Date,
+    Float,
+    event,
+    extract,
+    func,
+    inspect,
+    select,
+    text,
+    type_coerce
+)
+from sqlalchemy.exc import IntegrityError
 import json
 import os
 import enum
+import time
+from collections import Counter
 from datetime import date
+from functools import lru_cache
 
-database_path = os.environ['DATABASE_URL']
+from cache import response_cache
+import changes
+from dbpool import engine_options, configure_engine
+import replicas
+from replicas import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+# rows per multi-row INSERT statement and per IN (...) list
+BULK_CHUNK_SIZE = 500
+# compiled row formats kept (see ReadMixin.row_format)
+ROW_FORMAT_CACHE_SIZE = 64
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the database URL is taken from (in this order) the database_path
+    argument, the app's SQLALCHEMY_DATABASE_URI or the DATABASE_URL variable
+    no connection is opened until the first query
+    read-only routes may be routed to replicas, see replicas.py
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    database_path = (database_path or
+                     app.config.get("SQLALCHEMY_DATABASE_URI") or
+                     os.environ['DATABASE_URL'])
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    configure_engine(db.get_engine(app))
+    replicas.init_app(app)
 
 
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
+    for model in (Actor, Movie):
+        response_cache.invalidate(model.__tablename__)
+
+
+'''
+commit_write(*resources)
+    bumps the resources' versions in the same transaction as the pending
+    changes to them, commits, then invalidates their cached responses
+    all write paths of Actor, Movie and casting go through this function
+    it also applies the changes to the Stats recorded since the last commit,
+    logs the changes to the rows for the change feed (see changes.py) and
+    makes the client read its writes from the primary for a while
+'''
+
+
+def commit_write(*resources):
+    try:
+        db.session.flush()
+        events = log_write(resources,
+                           db.session.info.pop('stats_deltas', None),
+                           db.session.info.pop('changes', None))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for resource in resources:
+        response_cache.invalidate(resource)
+    replicas.record_write()
+    changes.publish_committed(events)
+
+
+'''
+log_write(resources, deltas, pending)
+    the bookkeeping of a write, in its transaction: adds the Counter of
+    Stats deltas, bumps the resources' versions and logs the pending
+    changes, then returns the events. On PostgreSQL this is a single
+    statement: the upserts and the INSERT into Changes are data-modifying
+    CTEs of the SELECT that sends the events with pg_notify. Elsewhere it
+    takes one statement per table.
+'''
+
+
+def log_write(resources, deltas, pending):
+    rows = Stats.delta_rows(deltas)
+    resources = sorted(set(resources))
+    if db.engine.dialect.name != 'postgresql':
+        for chunk in chunks(rows):
+            db.session.execute(*Stats.upsert(chunk))
+        if resources:
+            TableVersion.bump(*resources)
+        return Change.log(pending)
+    ctes = []
+    params = {}
+    for name, statement in (
+            ('stats', rows and Stats.upsert(rows)),
+            ('versions', resources and TableVersion.upsert(resources)),
+            ('logged', pending and Change.insert(pending, returning=True))):
+        if statement:
+            ctes.append(f'{name} AS ({statement[0].text})')
+            params.update(statement[1])
+    if not ctes:
+        return []
+    if not pending:
+        db.session.execute(text(f'WITH {", ".join(ctes)} SELECT 1'),
+                           params)
+        return []
+    params['channel'] = changes.CHANGES_CHANNEL
+    # one notification per event, whose ids fit in a pg_notify payload
+    # (see record_change)
+    logged = db.session.execute(text(
+        f'WITH {", ".join(ctes)} '
+        'SELECT seq, resource, op, ids, pg_notify(:channel, CAST('
+        "json_build_array(json_build_object('seq', seq, "
+        "'resource', resource, 'op', op, 'ids', CAST(ids AS json))) "
+        'AS text)) FROM logged ORDER BY seq'), params).fetchall()
+    events = [{'seq': seq, 'resource': resource, 'op': op,
+               'ids': json.loads(ids)}
+              for seq, resource, op, ids, _ in logged]
+    Change.prune(events[0]['seq'], events[-1]['seq'])
+    return events
+
+
+'''
+TableVersion
+    a version counter per table, incremented by every committed write to the
+    table. Reading it is a single primary key lookup, which makes it a cheap
+    basis for ETags and for cache keys shared by all workers.
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = "TableVersions"
+    resource = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+    '''
+    current(resource)
+        returns the resource's current version (0 if it was never written)
+    '''
+    @classmethod
+    def current(cls, resource):
+        version = db.session.query(cls.version) \
+            .filter(cls.resource == resource).scalar()
+        return version or 0
+
+    '''
+    bump(*resources)
+        increments the resources' versions in the current transaction
+    '''
+    @classmethod
+    def bump(cls, *resources):
+        db.session.execute(*cls.upsert(sorted(resources)))
+
+    '''
+    upsert(resources)
+        the INSERT ... ON CONFLICT DO UPDATE statement incrementing the
+        resources' versions, and its parameters
+    '''
+    @classmethod
+    def upsert(cls, resources):
+        values = ', '.join(f'(:version_resource{i}, 1)'
+                           for i in range(len(resources)))
+        return text(
+            f'INSERT INTO "{cls.__tablename__}" (resource, version) '
+            f'VALUES {values} ON CONFLICT (resource) DO UPDATE '
+            f'SET version = "{cls.__tablename__}".version + 1'), {
+                f'version_resource{i}': resource
+                for i, resource in enumerate(resources)}
+
+
+'''
+Change
+    the log of the changes made by committed writes, the source of the
+    change feed (see changes.py): one row per event, numbered by seq, which
+    is taken from the table's sequence (SQLite: its AUTOINCREMENT counter)
+    when the event is logged. ids is a JSON list of the changed rows' ids
+    ([movie_id, actor_id] pairs for castings, empty for a reload) and
+    logged_at the time of the log, in seconds since the epoch.
+'''
+
+
+class Change(db.Model):
+    __tablename__ = "Changes"
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'),
+                 primary_key=True)
+    resource = Column(String, nullable=False)
+    op = Column(String, nullable=False)
+    ids = Column(String, nullable=False)
+    logged_at = Column(Float, nullable=False)
+
+    '''
+    insert(pending, returning)
+        the INSERT statement logging the pending changes recorded by
+        record_change, and its parameters; with returning, it returns the
+        events (PostgreSQL)
+    '''
+    @classmethod
+    def insert(cls, pending, returning=False):
+        values = ', '.join(
+            f'(:change_resource{i}, :change_op{i}, :change_ids{i}, '
+            ':logged_at)' for i in range(len(pending)))
+        params = {'logged_at': time.time()}
+        for i, (resource, op, ids) in enumerate(pending):
+            params.update({f'change_resource{i}': resource,
+                           f'change_op{i}': op,
+                           f'change_ids{i}': json.dumps(ids)})
+        return text(
+            f'INSERT INTO "{cls.__tablename__}" '
+            f'(resource, op, ids, logged_at) VALUES {values}' +
+            (' RETURNING seq, resource, op, ids' if returning else '')), \
+            params
+
+    '''
+    log(pending)
+        logs the pending changes with one INSERT and returns the events,
+        with their sequence numbers (on PostgreSQL, log_write does this)
+    '''
+    @classmethod
+    def log(cls, pending):
+        if not pending:
+            return []
+        # SQLite has one writer at a time, so the rows of one INSERT get
+        # consecutive ids
+        last = db.session.execute(*cls.insert(pending)).lastrowid
+        first = last - len(pending) + 1
+        cls.prune(first, last)
+        return [{'seq': seq, 'resource': resource, 'op': op, 'ids': ids}
+                for seq, (resource, op, ids) in enumerate(pending, first)]
+
+    '''
+    prune(first, last)
+        deletes the events before the last CHANGES_RETAIN whenever a write's
+        sequence numbers first to last cross a multiple of
+        CHANGES_PRUNE_EVERY
+    '''
+    @classmethod
+    def prune(cls, first, last):
+        if (first - 1) // changes.CHANGES_PRUNE_EVERY != \
+                last // changes.CHANGES_PRUNE_EVERY:
+            table = cls.__table__
+            db.session.execute(table.delete().where(
+                table.c.seq <= last - changes.CHANGES_RETAIN))
+
+    '''
+    since(seq, limit)
+        the first limit events after the sequence number seq, with the time
+        they were logged
+    '''
+    @classmethod
+    def since(cls, seq, limit):
+        table = cls.__table__
+        rows = db.session.execute(
+            select([table.c.seq, table.c.resource, table.c.op, table.c.ids,
+                    table.c.logged_at])
+            .where(table.c.seq > seq).order_by(table.c.seq).limit(limit))
+        return [{'seq': seq, 'resource': resource, 'op': op,
+                 'ids': json.loads(ids), 'logged_at': logged_at}
+                for seq, resource, op, ids, logged_at in rows]
+
+    '''
+    latest() / oldest()
+        the sequence number of the latest (0 if the log is empty) and the
+        oldest (or None) event in the log
+    '''
+    @classmethod
+    def latest(cls):
+        return db.session.query(func.max(cls.seq)).scalar() or 0
+
+    @classmethod
+    def oldest(cls):
+        return db.session.query(func.min(cls.seq)).scalar()
+
+    '''
+    watermark(settled)
+        the sequence number up to which the log is complete: that of the
+        latest event logged by the time settled (events after it may still
+        be preceded by writes that have not committed yet)
+    '''
+    @classmethod
+    def watermark(cls, settled):
+        seq = db.session.query(func.max(cls.seq)) \
+            .filter(cls.logged_at <= settled).scalar()
+        if seq is None:
+            oldest = cls.oldest()
+            seq = 0 if oldest is None else oldest - 1
+        return seq
+
+
+'''
+Stats
+    summary counts of actors and movies (totals and counts per dimension
+    bucket, e.g. actors by_gender female). Every write records the change
+    it makes to the counts, which commit_write applies in the write's
+    transaction, so reading them never scans Actors or Movies.
+'''
+
+
+class Stats(db.Model):
+    __tablename__ = "Stats"
+    resource = Column(String, primary_key=True)
+    dimension = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
+
+    '''
+    summary()
+        the counts as {resource: {"total": n, dimension: {bucket: n}}}
+    '''
+    @classmethod
+    def summary(cls):
+        summary = {'actors': {'total': 0}, 'movies': {'total': 0}}
+        rows = db.session.query(cls.resource, cls.dimension, cls.bucket,
+                                cls.count).filter(cls.count != 0)
+        for resource, dimension, bucket, count in rows:
+            if dimension == 'total':
+                summary[resource]['total'] = count
+            else:
+                summary[resource].setdefault(dimension, {})[bucket] = count
+        return summary
+
+    '''
+    compute()
+        the counts computed from scratch with one GROUP BY per dimension,
+        as a Counter keyed by (resource, dimension, bucket)
+    '''
+    @classmethod
+    def compute(cls):
+        counts = Counter()
+        queries = [
+            ('actors', 'by_gender', Actor.gender),
+            # integer division, in SQLite and PostgreSQL alike
+            ('actors', 'by_age', Actor.age / 10 * 10),
+            # EXTRACT gives a double precision on PostgreSQL
+            ('movies', 'by_release_year',
+             cast(extract('year', Movie.release_date), Integer))
+        ]
+        for resource, dimension, expression in queries:
+            rows = db.session.query(expression, func.count()) \
+                .group_by(expression)
+            for value, count in rows:
+                bucket = stats_bucket(dimension, value)
+                counts[(resource, dimension, bucket)] += count
+        for model in (Actor, Movie):
+            counts[(model.STATS_RESOURCE, 'total', '')] = \
+                db.session.query(func.count(model.id)).scalar()
+        return counts
+
+    '''
+    rebuild()
+        replaces the counts with compute(), e.g. after writes that bypassed
+        the models
+    '''
+    @classmethod
+    def rebuild(cls):
+        db.session.query(cls).delete()
+        cls.apply(cls.compute())
+        db.session.commit()
+
+    '''
+    apply(deltas)
+        adds a Counter of changes to the counts in the current transaction,
+        with one upsert statement per BULK_CHUNK_SIZE buckets
+    '''
+    @classmethod
+    def apply(cls, deltas):
+        for chunk in chunks(cls.delta_rows(deltas)):
+            db.session.execute(*cls.upsert(chunk))
+
+    '''
+    delta_rows(deltas)
+        the non-zero deltas as (resource, dimension, bucket, delta) rows, in
+        a fixed order, so concurrent writes can't deadlock
+    '''
+    @staticmethod
+    def delta_rows(deltas):
+        return [key + (delta,)
+                for key, delta in sorted((deltas or {}).items()) if delta]
+
+    '''
+    upsert(rows)
+        the INSERT ... ON CONFLICT DO UPDATE statement adding the delta
+        rows to the counts, and its parameters
+    '''
+    @classmethod
+    def upsert(cls, rows):
+        values = ', '.join(
+            f'(:stats_resource{i}, :stats_dimension{i}, :stats_bucket{i}, '
+            f':stats_count{i})' for i in range(len(rows)))
+        params = {}
+        for i, (resource, dimension, bucket, delta) in enumerate(rows):
+            params.update({f'stats_resource{i}': resource,
+                           f'stats_dimension{i}': dimension,
+                           f'stats_bucket{i}': bucket,
+                           f'stats_count{i}': delta})
+        return text(
+            f'INSERT INTO "{cls.__tablename__}" '
+            f'(resource, dimension, bucket, count) VALUES {values} '
+            'ON CONFLICT (resource, dimension, bucket) DO UPDATE '
+            f'SET count = "{cls.__tablename__}".count + excluded.count'), \
+            params
+
+
+'''
+stats_bucket(dimension, value)
+    the bucket of a column value in a Stats dimension
+'''
+
+
+def stats_bucket(dimension, value):
+    if value is None:
+        return 'unknown'
+    if dimension == 'by_age':
+        low = max(int(value), 0) // 10 * 10
+        return f'{low}-{low + 9}'
+    if dimension == 'by_release_year':
+        # the date of a written row (or its ISO string), or the year of
+        # compute()
+        if isinstance(value, date):
+            value = value.year
+        elif isinstance(value, str):
+            value = value[:4]
+        return str(int(value))
+    return str(format_value(value))
+
+
+'''
+record_stats(model, old, new)
+    records the change to the Stats made by replacing a row's column values
+    old with new (dicts; None for an inserted or deleted row), to be applied
+    by the next commit_write
+'''
+
+
+def record_stats(model, old, new):
+    deltas = db.session.info.setdefault('stats_deltas', Counter())
+    for values, sign in ((old, -1), (new, 1)):
+        if values is None:
+            continue
+        deltas[(model.STATS_RESOURCE, 'total', '')] += sign
+        for dimension, field in model.STATS_DIMENSIONS:
+            bucket = stats_bucket(dimension, values.get(field))
+            deltas[(model.STATS_RESOURCE, dimension, bucket)] += sign
+
+
+'''
+record_change(resource, op, ids)
+    records a change ("insert", "update", "delete" or "reload") to rows of
+    the resource ("actors", "movies" or "castings") for the change feed, to
+    be logged by the next commit_write, as one event per BULK_CHUNK_SIZE ids
+    (half as many [movie_id, actor_id] pairs), which keeps every event
+    within the 8000 bytes of a pg_notify payload
+'''
+
+
+def record_change(resource, op, ids):
+    if not changes.CHANGES_ENABLED:
+        return
+    pending = db.session.info.setdefault('changes', [])
+    if op == 'reload':
+        pending.append((resource, op, []))
+    size = BULK_CHUNK_SIZE // 2 if resource == 'castings' \
+        else BULK_CHUNK_SIZE
+    for chunk in chunks(list(ids), size):
+        pending.append((resource, op, chunk))
+
+
+def committed_values(instance):
+    state = inspect(instance)
+    values = {}
+    for field in instance.FIELDS:
+        history = state.attrs[field].history
+        values[field] = (history.deleted[0] if history.deleted
+                         else getattr(instance, field))
+    return values
+
+
+def current_values(instance):
+    return {field: getattr(instance, field) for field in instance.FIELDS}
+
+
+# changes made through the session (insert(), update() and delete()) are
+# recorded when they are flushed; the bulk paths record their own
+@event.listens_for(db.session, 'before_flush')
+def record_session_stats(session, flush_context, instances):
+    for instance in session.new:
+        if hasattr(instance, 'STATS_RESOURCE'):
+            record_stats(type(instance), None, current_values(instance))
+    for instance in session.deleted:
+        if hasattr(instance, 'STATS_RESOURCE'):
+            record_stats(type(instance), committed_values(instance), None)
+    for instance in session.dirty:
+        if hasattr(instance, 'STATS_RESOURCE') and \
+                session.is_modified(instance):
+            record_stats(type(instance), committed_values(instance),
+                         current_values(instance))
+
+
+# after the flush, when inserted rows have their ids
+@event.listens_for(db.session, 'after_flush')
+def record_session_changes(session, flush_context):
+    ids = {}
+    for instances, op in ((session.new, 'insert'),
+                          (session.deleted, 'delete'),
+                          (session.dirty, 'update')):
+        for instance in instances:
+            if not hasattr(instance, 'STATS_RESOURCE') or \
+                    op == 'update' and not session.is_modified(instance):
+                continue
+            key = (instance.STATS_RESOURCE, op)
+            ids.setdefault(key, []).append(instance.id)
+    for (resource, op), resource_ids in ids.items():
+        record_change(resource, op, sorted(resource_ids))
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_session_stats(session, previous_transaction):
+    session.info.pop('stats_deltas', None)
+    session.info.pop('changes', None)
 
 
 class Gender(enum.Enum):
@@ -34,13 +553,417 @@ class Gender(enum.Enum):
     other = 3
 
 
-class Actor(db.Model):
+'''
+format_value(value)
+    JSON representation of a single column value, as used by format()
+'''
+
+
+def format_value(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def format_date(value):
+    # dates selected without conversion are already ISO strings on SQLite
+    return value if isinstance(value, str) else value.isoformat()
+
+
+'''
+compile_row_format(model, fields)
+    the columns to select for the fields and a function that turns a
+    selected row into the same item as the model's format() (with only the
+    fields). Enums and dates are selected without SQLAlchemy's result
+    conversion (enums are stored by their name), and only dates are
+    converted per row.
+'''
+
+
+def compile_row_format(model, fields):
+    columns = []
+    converters = []
+    for field in fields:
+        column = getattr(model, field)
+        if isinstance(column.type, Date):
+            converters.append((field, format_date))
+        if isinstance(column.type, (Date, Enum)):
+            column = type_coerce(column, String).label(field)
+        columns.append(column)
+
+    if not converters:
+        def format_row(row):
+            return dict(zip(fields, row))
+        return columns, format_row
+
+    def format_row(row):
+        item = dict(zip(fields, row))
+        for field, convert in converters:
+            if item[field] is not None:
+                item[field] = convert(item[field])
+        return item
+    return columns, format_row
+
+
+'''
+cached_row_format(model, fields)
+    compile_row_format, keeping the last ROW_FORMAT_CACHE_SIZE row formats
+'''
+
+
+@lru_cache(maxsize=ROW_FORMAT_CACHE_SIZE)
+def cached_row_format(model, fields):
+    return compile_row_format(model, fields)
+
+
+'''
+casting
+    the many-to-many association of actors and the movies they are cast in.
+    The primary key indexes actor_id; movie_id has an index of its own.
+    Both foreign keys cascade deletes.
+'''
+
+casting = db.Table(
+    "Castings",
+    Column('actor_id', Integer, ForeignKey('Actors.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('movie_id', Integer, ForeignKey('Movies.id', ondelete='CASCADE'),
+           primary_key=True),
+    Index('ix_Castings_movie_id', 'movie_id')
+)
+
+
+'''
+ReadMixin
+    column-only read paths shared by Actor and Movie. Rows are selected as
+    plain tuples with Core statements, which skip the ORM's identity map,
+    change tracking and autoflush, and turned into items by a mapping that
+    is compiled once per list of fields.
+'''
+
+
+class ReadMixin:
+    '''
+    row_format(fields)
+        the columns to select for the fields and the function that turns a
+        selected row into its item (see compile_row_format)
+    '''
+    @classmethod
+    def row_format(cls, fields):
+        return cached_row_format(cls, tuple(fields))
+
+    '''
+    select_rows(fields, filters, after, limit)
+        the statement selecting the fields of the matching rows ordered by
+        id, starting after the id "after", and the function formatting them
+    '''
+    @classmethod
+    def select_rows(cls, fields, filters=(), after=None, limit=None):
+        columns, format_row = cls.row_format(fields)
+        statement = select(columns)
+        for condition in filters:
+            statement = statement.where(condition)
+        if after is not None:
+            statement = statement.where(cls.id > after)
+        statement = statement.order_by(cls.id)
+        if limit is not None:
+            statement = statement.limit(limit)
+        return statement, format_row
+
+
+'''
+BulkMixin
+    set-based write paths shared by Actor and Movie. Each method runs all of
+    its statements in a single transaction and commits once.
+'''
+
+
+class BulkMixin:
+
+    '''
+    bulk_insert(rows)
+        inserts the rows (dicts of column values) with multi-row INSERT
+        statements and returns the inserted models
+        the rows must have unique values in the UNIQUE_FIELD column
+    '''
+    @classmethod
+    def bulk_insert(cls, rows):
+        if not rows:
+            return []
+        table = cls.__table__
+        values = [row[cls.UNIQUE_FIELD] for row in rows]
+        postgres = db.engine.dialect.name == 'postgresql'
+        try:
+            ids = []
+            for chunk in chunks(rows):
+                statement = table.insert().values(chunk)
+                if postgres:
+                    ids.extend(row_id for row_id, in db.session.execute(
+                        statement.returning(table.c.id)))
+                else:
+                    db.session.execute(statement)
+            if not postgres:
+                ids = cls._ids(values)
+            for row in rows:
+                record_stats(cls, None, row)
+            record_change(cls.STATS_RESOURCE, 'insert', sorted(ids))
+        except Exception:
+            db.session.rollback()
+            raise
+        commit_write(cls.__tablename__)
+        return cls.find_unique(values)
+
+    '''
+    bulk_update(rows)
+        updates the rows (dicts of column values including the id)
+        the rows must exist in the database
+    '''
+    @classmethod
+    def bulk_update(cls, rows):
+        try:
+            old = cls._values([row['id'] for row in rows])
+            db.session.bulk_update_mappings(cls, rows)
+            for row in rows:
+                record_stats(cls, old[row['id']], dict(old[row['id']], **row))
+            record_change(cls.STATS_RESOURCE, 'update',
+                          [row['id'] for row in rows])
+        except Exception:
+            db.session.rollback()
+            raise
+        commit_write(cls.__tablename__)
+
+    '''
+    bulk_delete(ids)
+        deletes the rows with the given ids
+    '''
+    @classmethod
+    def bulk_delete(cls, ids):
+        column = casting.c[cls.CASTING_KEY]
+        try:
+            for chunk in chunks(ids):
+                old = cls._values(chunk)
+                for values in old.values():
+                    record_stats(cls, values, None)
+                record_change(cls.STATS_RESOURCE, 'delete', list(old))
+                # explicitly, since SQLite doesn't enforce ON DELETE CASCADE
+                # by default
+                db.session.execute(
+                    casting.delete().where(column.in_(chunk)))
+                cls.query.filter(cls.id.in_(chunk)) \
+                    .delete(synchronize_session=False)
+        except Exception:
+            db.session.rollback()
+            raise
+        commit_write(cls.__tablename__)
+
+    '''
+    insert_row(values)
+        inserts one row with the given column values and returns its
+        formatted item. On PostgreSQL this is a single INSERT ... RETURNING
+        statement; elsewhere the item is made from the values and the new
+        row's id, so the row isn't selected again.
+    '''
+    @classmethod
+    def insert_row(cls, values):
+        table = cls.__table__
+        try:
+            if db.engine.dialect.name == 'postgresql':
+                columns, format_row = cls.row_format(cls.FIELDS)
+                item = format_row(db.session.execute(
+                    table.insert().values(values).returning(*columns))
+                    .first())
+                item_id = item['id']
+            else:
+                item_id = db.session.execute(
+                    table.insert().values(values)).lastrowid
+                item = {field: format_value(values.get(field))
+                        for field in cls.FIELDS}
+                item['id'] = item_id
+            record_stats(cls, None, values)
+            record_change(cls.STATS_RESOURCE, 'insert', [item_id])
+        except Exception:
+            db.session.rollback()
+            raise
+        commit_write(cls.__tablename__)
+        return item
+
+    '''
+    update_row(item_id, values)
+        updates one row with the given column values and returns its
+        formatted item, or None if it doesn't exist. On PostgreSQL this is
+        a single UPDATE ... RETURNING statement, which also returns the old
+        values (for the Stats) from a locked self-join.
+    '''
+    @classmethod
+    def update_row(cls, item_id, values):
+        table = cls.__table__
+        columns, format_row = cls.row_format(cls.FIELDS)
+        count = len(cls.FIELDS)
+        if not values:
+            old_values = cls._values([item_id]).get(item_id)
+            if old_values is None:
+                return None
+            return {field: format_value(value)
+                    for field, value in old_values.items()}
+        old_values = None
+        try:
+            if db.engine.dialect.name == 'postgresql':
+                old = select([table.c[f] for f in cls.FIELDS]) \
+                    .where(table.c.id == item_id).with_for_update() \
+                    .alias('old')
+                row = db.session.execute(
+                    table.update().values(values)
+                    .where(table.c.id == old.c.id)
+                    .returning(*columns + [old.c[f].label('old_' + f)
+                                           for f in cls.FIELDS])).first()
+                if row is not None:
+                    item = format_row(row[:count])
+                    old_values = dict(zip(cls.FIELDS, row[count:]))
+            else:
+                old_values = cls._values([item_id]).get(item_id)
+                if old_values is not None:
+                    db.session.execute(table.update().values(values)
+                                       .where(table.c.id == item_id))
+                    item = {field: format_value(value) for field, value
+                            in dict(old_values, **values).items()}
+            if old_values is None:
+                db.session.rollback()
+                return None
+            record_stats(cls, old_values, dict(old_values, **values))
+            record_change(cls.STATS_RESOURCE, 'update', [item_id])
+        except Exception:
+            db.session.rollback()
+            raise
+        commit_write(cls.__tablename__)
+        return item
+
+    '''
+    delete_row(item_id)
+        deletes one row and returns whether it existed. On PostgreSQL this
+        is a single DELETE ... RETURNING statement; the database deletes
+        its castings (ON DELETE CASCADE).
+    '''
+    @classmethod
+    def delete_row(cls, item_id):
+        table = cls.__table__
+        try:
+            if db.engine.dialect.name == 'postgresql':
+                row = db.session.execute(
+                    table.delete().where(table.c.id == item_id)
+                    .returning(*[table.c[f] for f in cls.FIELDS])).first()
+                old_values = dict(zip(cls.FIELDS, row)) if row else None
+            else:
+                old_values = cls._values([item_id]).get(item_id)
+                if old_values is not None:
+                    # explicitly, since SQLite doesn't enforce ON DELETE
+                    # CASCADE by default
+                    db.session.execute(casting.delete().where(
+                        casting.c[cls.CASTING_KEY] == item_id))
+                    db.session.execute(
+                        table.delete().where(table.c.id == item_id))
+            if old_values is None:
+                db.session.rollback()
+                return False
+            record_stats(cls, old_values, None)
+            record_change(cls.STATS_RESOURCE, 'delete', [item_id])
+        except Exception:
+            db.session.rollback()
+            raise
+        commit_write(cls.__tablename__)
+        return True
+
+    '''
+    existing_unique(values) / existing_ids(ids)
+        return the subset of the given UNIQUE_FIELD values / ids that exist
+        in the database, selecting only that column
+    '''
+    @classmethod
+    def existing_unique(cls, values):
+        return cls._existing(getattr(cls, cls.UNIQUE_FIELD), values)
+
+    @classmethod
+    def existing_ids(cls, ids):
+        return cls._existing(cls.id, ids)
+
+    '''
+    _values(ids)
+        the column values of the rows with the given ids, by id
+    '''
+    @classmethod
+    def _values(cls, ids):
+        columns = [getattr(cls, field) for field in cls.FIELDS]
+        values = {}
+        for chunk in chunks(list(ids)):
+            for row in db.session.query(*columns).filter(cls.id.in_(chunk)):
+                values[row.id] = dict(zip(cls.FIELDS, row))
+        return values
+
+    '''
+    _ids(values)
+        the ids of the rows with the given UNIQUE_FIELD values
+    '''
+    @classmethod
+    def _ids(cls, values):
+        column = getattr(cls, cls.UNIQUE_FIELD)
+        ids = []
+        for chunk in chunks(list(values)):
+            ids.extend(row_id for row_id, in db.session.query(cls.id)
+                       .filter(column.in_(chunk)))
+        return ids
+
+    @classmethod
+    def _existing(cls, column, values):
+        found = set()
+        for chunk in chunks(list(values)):
+            query = db.session.query(column).filter(column.in_(chunk))
+            found.update(value for value, in query)
+        return found
+
+    '''
+    find_unique(values) / find_ids(ids)
+        load the models matching a list of UNIQUE_FIELD values / ids using
+        one IN (...) query per BULK_CHUNK_SIZE values
+    '''
+    @classmethod
+    def find_unique(cls, values):
+        column = getattr(cls, cls.UNIQUE_FIELD)
+        found = []
+        for chunk in chunks(list(values)):
+            found.extend(cls.query.filter(column.in_(chunk)).all())
+        return found
+
+    @classmethod
+    def find_ids(cls, ids):
+        found = []
+        for chunk in chunks(list(ids)):
+            found.extend(cls.query.filter(cls.id.in_(chunk)).all())
+        return found
+
+
+def chunks(items, size=BULK_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Actor(ReadMixin, BulkMixin, db.Model):
     __tablename__ = "Actors"
     id = Column(Integer, primary_key=True)
     name = Column(String, unique=True, nullable=False)
     age = Column(Integer)
     gender = Column(Enum(Gender))
 
+    movies = db.relationship('Movie', secondary=casting,
+                             back_populates='actors', order_by='Movie.id')
+
+    FIELDS = ('id', 'name', 'age', 'gender')
+    UNIQUE_FIELD = 'name'
+    SEARCH_FIELD = 'name'
+    STATS_RESOURCE = 'actors'
+    STATS_DIMENSIONS = (('by_gender', 'gender'), ('by_age', 'age'))
+    CASTING_KEY = 'actor_id'
+
     """
     METHODS ADAPTED FROM COFFEE_SHOP PROJECT models.py FILE
     """
@@ -54,7 +977,7 @@ class Actor(db.Model):
             'id': self.id,
             'name': self.name,
             'age': self.age,
-            'gender': self.gender.name
+            'gender': format_value(self.gender)
         }
 
     '''
@@ -65,7 +988,7 @@ class Actor(db.Model):
     '''
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     '''
     delete()
@@ -74,7 +997,7 @@ class Actor(db.Model):
     '''
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     '''
     update()
@@ -82,18 +1005,28 @@ class Actor(db.Model):
         the model must exist in the database
     '''
     def update(self):
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     def __repr__(self):
         return json.dumps(self.format())
 
 
-class Movie(db.Model):
+class Movie(ReadMixin, BulkMixin, db.Model):
     __tablename__ = "Movies"
     id = Column(Integer, primary_key=True)
     title = Column(String, unique=True, nullable=False)
     release_date = Column(Date)
 
+    actors = db.relationship('Actor', secondary=casting,
+                             back_populates='movies', order_by='Actor.id')
+
+    FIELDS = ('id', 'title', 'release_date')
+    UNIQUE_FIELD = 'title'
+    SEARCH_FIELD = 'title'
+    STATS_RESOURCE = 'movies'
+    STATS_DIMENSIONS = (('by_release_year', 'release_date'),)
+    CASTING_KEY = 'movie_id'
+
     """
     METHODS ADAPTED FROM COFFEE_SHOP PROJECT models.py FILE
     """
@@ -106,7 +1039,7 @@ class Movie(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date.isoformat()
+            'release_date': format_value(self.release_date)
         }
 
     '''
@@ -117,7 +1050,7 @@ class Movie(db.Model):
     '''
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     '''
     delete()
@@ -126,7 +1059,45 @@ class Movie(db.Model):
     '''
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_write(self.__tablename__)
+
+    '''
+    assign(actor_id) / unassign(actor_id)
+        casts an actor in the movie / removes them from its cast, writing
+        only the association row; both return False if nothing changed
+    '''
+    def assign(self, actor_id):
+        try:
+            # a casting that exists, e.g. assigned concurrently, is left
+            # alone
+            result = db.session.execute(text(
+                f'INSERT INTO "{casting.name}" (actor_id, movie_id) '
+                'VALUES (:actor_id, :movie_id) ON CONFLICT DO NOTHING'),
+                {'actor_id': actor_id, 'movie_id': self.id})
+        except IntegrityError:
+            # the actor or the movie was deleted concurrently
+            db.session.rollback()
+            return False
+        if result.rowcount == 0:
+            db.session.rollback()
+            return False
+        record_change('castings', 'insert', [[self.id, actor_id]])
+        commit_write(Actor.__tablename__, self.__tablename__)
+        return True
+
+    def unassign(self, actor_id):
+        result = db.session.execute(
+            casting.delete().where(self._cast_row(actor_id)))
+        if result.rowcount == 0:
+            db.session.rollback()
+            return False
+        record_change('castings', 'delete', [[self.id, actor_id]])
+        commit_write(Actor.__tablename__, self.__tablename__)
+        return True
+
+    def _cast_row(self, actor_id):
+        return and_(casting.c.movie_id == self.id,
+                    casting.c.actor_id == actor_id)
 
     '''
     update()
@@ -134,7 +1105,7 @@ class Movie(db.Model):
         the model must exist in the database
     '''
     def update(self):
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     def __repr__(self):
         return json.dumps(self.format())
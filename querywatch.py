@@ -0,0 +1,211 @@
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+"""
+Query budget, N+1 and slow query detection for development and test runs.
+
+When enabled, every SQL statement executed during a request is counted,
+timed and fingerprinted (literals and placeholders replaced by "?", IN lists
+and multi-row VALUES collapsed). After the request, the route is checked
+against
+    - its query budget: at most QUERY_BUDGET statements,
+    - the repeat limit: no fingerprint more than QUERY_REPEAT_LIMIT times,
+      which is what an N+1 pattern looks like,
+    - the slow query threshold: no statement slower than QUERY_SLOW_MS.
+Violations are logged as warnings (QUERY_WATCH=warn) or raised as
+QueryBudgetExceeded (QUERY_WATCH=raise). All settings can also be passed to
+create_app(test_config), which takes precedence over the environment.
+"""
+
+# off, warn or raise
+QUERY_WATCH = os.environ.get('QUERY_WATCH', 'off')
+QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', 20))
+QUERY_REPEAT_LIMIT = int(os.environ.get('QUERY_REPEAT_LIMIT', 5))
+# milliseconds, 0 to disable the slow query check
+QUERY_SLOW_MS = float(os.environ.get('QUERY_SLOW_MS', 200))
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+'''
+QueryReport
+    the statements executed during one request, as (fingerprint, seconds,
+    statement) tuples
+'''
+
+
+class QueryReport:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    def repeats(self):
+        return Counter(fingerprint for fingerprint, seconds, statement
+                       in self.queries)
+
+    '''
+    violations(budget, repeat_limit, slow_seconds)
+        descriptions of the ways the request broke the given limits
+    '''
+    def violations(self, budget, repeat_limit, slow_seconds):
+        found = []
+        if budget is not None and len(self) > budget:
+            found.append(f'{self.endpoint} executed {len(self)} queries '
+                         f'(budget: {budget})')
+        if repeat_limit is not None:
+            for fingerprint, count in self.repeats().most_common():
+                if count <= repeat_limit:
+                    break
+                found.append(f'{self.endpoint} executed the same query '
+                             f'{count} times (limit: {repeat_limit}), '
+                             f'possible N+1: {fingerprint}')
+        if slow_seconds:
+            for fingerprint, seconds, statement in self.queries:
+                if seconds > slow_seconds:
+                    found.append(f'{self.endpoint} executed a slow query '
+                                 f'({seconds * 1000:.1f} ms): {fingerprint}')
+        return found
+
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|:\w+|\?')
+IN_LIST = re.compile(r'\(\?(?:,\s*\?)+\)')
+VALUES_LIST = re.compile(r'\(\?\)(?:,\s*\(\?\))+')
+WHITESPACE = re.compile(r'\s+')
+
+'''
+fingerprint(statement)
+    the shape of a SQL statement, equal for statements that only differ in
+    their parameters or the length of their IN lists
+'''
+
+
+def fingerprint(statement):
+    statement = STRING.sub('?', statement)
+    statement = NUMBER.sub('?', statement)
+    statement = PLACEHOLDER.sub('?', statement)
+    statement = IN_LIST.sub('(?)', statement)
+    statement = VALUES_LIST.sub('(?)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+_captures = []
+
+'''
+capture_queries()
+    context manager that yields a list to which the QueryReport of every
+    request handled within the block is appended, e.g.
+        with capture_queries() as reports:
+            client.get('/actors')
+        assert len(reports[0]) <= 2
+'''
+
+
+@contextmanager
+def capture_queries():
+    reports = []
+    _captures.append(reports)
+    try:
+        yield reports
+    finally:
+        _captures.remove(reports)
+
+
+'''
+@query_budget(queries, repeats)
+    decorator that overrides the query budget and repeat limit of a route,
+    e.g. for routes that run one statement per chunk of their input. The
+    other decorators of the route must preserve it with functools.wraps.
+'''
+
+
+def query_budget(queries=None, repeats=None):
+    def query_budget_decorator(f):
+        f.query_budget = (queries, repeats)
+        return f
+    return query_budget_decorator
+
+
+def current_report():
+    if not has_request_context():
+        return None
+    return g.get('query_report')
+
+
+'''
+watch_engine(app, engine)
+    records the statements the engine executes during requests, unless the
+    detector is off
+'''
+
+
+def watch_engine(app, engine):
+    if app.config['QUERY_WATCH'] == 'off':
+        return
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        context._query_watch_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        seconds = time.perf_counter() - context._query_watch_start
+        report = current_report()
+        if report is not None:
+            report.queries.append((fingerprint(statement), seconds,
+                                   statement))
+
+
+'''
+init_app(app, engine)
+    registers the hooks that record and check the statements of every
+    request, unless the detector is off
+'''
+
+
+def init_app(app, engine):
+    app.config.setdefault('QUERY_WATCH', QUERY_WATCH)
+    app.config.setdefault('QUERY_BUDGET', QUERY_BUDGET)
+    app.config.setdefault('QUERY_REPEAT_LIMIT', QUERY_REPEAT_LIMIT)
+    app.config.setdefault('QUERY_SLOW_MS', QUERY_SLOW_MS)
+    if app.config['QUERY_WATCH'] == 'off':
+        return
+    watch_engine(app, engine)
+
+    @app.before_request
+    def start_report():
+        g.query_report = QueryReport(request.endpoint)
+
+    @app.after_request
+    def check_report(response):
+        report = current_report()
+        if report is None:
+            return response
+        # later statements (e.g. of a streamed response) are not checked
+        g.query_report = None
+        for reports in _captures:
+            reports.append(report)
+        view = app.view_functions.get(request.endpoint)
+        budget, repeat_limit = getattr(view, 'query_budget', (None, None))
+        violations = report.violations(
+            budget or app.config['QUERY_BUDGET'],
+            repeat_limit or app.config['QUERY_REPEAT_LIMIT'],
+            app.config['QUERY_SLOW_MS'] / 1000)
+        if violations and app.config['QUERY_WATCH'] == 'raise':
+            raise QueryBudgetExceeded('; '.join(violations))
+        for violation in violations:
+            app.logger.warning(violation)
+        return response
@@ -0,0 +1,274 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, has_app_context, request
+
+"""
+Admission control: per-client rate limits and a cap on concurrent requests.
+
+RATE_LIMITS sets one token bucket per client and permission, as
+comma-separated "permission=rate/burst" entries: a client (the sub claim of
+its token) may send up to burst requests at once, and rate requests per
+second on average, to the routes requiring that permission. "*" applies to
+the permissions without an entry of their own, e.g.
+    RATE_LIMITS="*=20/40,post:actors=2/10"
+requires_auth checks the limit right after the token, so a request over it
+is answered with 429 Too Many Requests before the route touches the database.
+
+MAX_CONCURRENT_REQUESTS caps the API requests a worker serves at once, which
+matters with the gevent profile (see gunicorn.conf.py), where a worker
+serves many. Requests above the cap are answered with 503 Service
+Unavailable before they are authenticated. Both responses carry a
+Retry-After header. Both are off by default.
+"""
+
+RATE_LIMITS = os.environ.get('RATE_LIMITS', '')
+# 0 disables the cap
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 0))
+# Retry-After of the 503 responses, in seconds
+CONCURRENCY_RETRY_AFTER = int(os.environ.get('CONCURRENCY_RETRY_AFTER', 1))
+# buckets kept by the in-process backend; the least recently used bucket
+# is dropped beyond that (it is full again by then, unless the limit is
+# very low)
+MAX_RATE_LIMIT_BUCKETS = int(
+    os.environ.get('MAX_RATE_LIMIT_BUCKETS', 10000))
+
+# routes that are never shed, so the app can be monitored under overload
+EXEMPT_ENDPOINTS = {'static', 'home_page', 'login_page', 'callback_page',
+                    'get_metrics'}
+# long-lived streams, capped by MAX_CHANGE_SUBSCRIBERS instead (see
+# changes.py)
+STREAM_ENDPOINTS = {'get_changes_stream'}
+
+
+'''
+RateLimitError Exception
+    a request that was shed; retry_after is in seconds
+'''
+
+
+class RateLimitError(Exception):
+    def __init__(self, error, status_code, retry_after):
+        self.error = error
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+'''
+parse_limits(limits)
+    the limits of a RATE_LIMITS string as {permission: (rate, burst)}
+    raises ValueError if an entry is malformed
+'''
+
+
+def parse_limits(limits):
+    if not isinstance(limits, str):
+        return dict(limits)
+    parsed = {}
+    for entry in limits.split(','):
+        if not entry.strip():
+            continue
+        try:
+            permission, limit = entry.split('=')
+            rate, burst = limit.split('/')
+            rate, burst = float(rate), float(burst)
+        except ValueError:
+            raise ValueError(f'invalid RATE_LIMITS entry: {entry!r}')
+        if rate <= 0 or burst < 1:
+            raise ValueError(f'invalid RATE_LIMITS entry: {entry!r}')
+        parsed[permission.strip()] = (rate, burst)
+    return parsed
+
+
+'''
+RateLimitBackend
+    the interface of a rate limit backend, which stores the token buckets.
+    Implement it to share the buckets between workers (e.g. backed by
+    Redis); otherwise every worker enforces the limits on its own.
+'''
+
+
+class RateLimitBackend:
+    '''
+    take(key, rate, burst)
+        takes a token from the bucket key, which holds up to burst tokens
+        and refills at rate tokens per second
+        returns 0 if a token was taken, or else the seconds until the next
+        one is available
+    '''
+    def take(self, key, rate, burst):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+'''
+InProcessRateLimitBackend
+    the default backend, a bounded LRU dict of (tokens, updated_at) per key
+'''
+
+
+class InProcessRateLimitBackend(RateLimitBackend):
+    def __init__(self, max_buckets=None):
+        self.max_buckets = (MAX_RATE_LIMIT_BUCKETS if max_buckets is None
+                            else max_buckets)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        return {'buckets': len(self._buckets)}
+
+
+'''
+RateLimiter
+    the rate limits and the concurrency cap of an app, and the number of
+    requests each of them shed
+'''
+
+
+class RateLimiter:
+    def __init__(self, limits=None, max_concurrent=None, backend=None,
+                 retry_after=None):
+        self.limits = parse_limits(RATE_LIMITS if limits is None
+                                   else limits)
+        self.max_concurrent = (MAX_CONCURRENT_REQUESTS
+                               if max_concurrent is None
+                               else int(max_concurrent))
+        self.backend = backend or InProcessRateLimitBackend()
+        self.retry_after = (CONCURRENCY_RETRY_AFTER if retry_after is None
+                            else retry_after)
+        self.in_flight = 0
+        # (reason, permission) -> requests shed
+        self.shed = {}
+        self._lock = threading.Lock()
+
+    def limit(self, permission):
+        return self.limits.get(permission, self.limits.get('*'))
+
+    '''
+    check(permission, payload)
+        takes a token from the bucket of the token's subject and the
+        permission; raises RateLimitError (429) if the bucket is empty
+    '''
+    def check(self, permission, payload):
+        limit = self.limit(permission)
+        if limit is None:
+            return
+        client = payload.get('sub') or 'addr:' + str(request.remote_addr)
+        wait = self.backend.take(f'{client}:{permission}', *limit)
+        if wait:
+            self.record_shed('rate_limit', permission)
+            raise RateLimitError({
+                'code': 'rate_limited',
+                'description': 'Too many requests.'
+            }, 429, max(1, math.ceil(wait)))
+
+    '''
+    enter() / leave()
+        count a request in and out; enter() raises RateLimitError (503)
+        instead if the worker already serves max_concurrent requests
+    '''
+    def enter(self):
+        with self._lock:
+            if self.max_concurrent and \
+                    self.in_flight >= self.max_concurrent:
+                full = True
+            else:
+                full = False
+                self.in_flight += 1
+        if full:
+            self.record_shed('concurrency')
+            raise RateLimitError({
+                'code': 'overloaded',
+                'description': 'Too many concurrent requests.'
+            }, 503, self.retry_after)
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record_shed(self, reason, permission=''):
+        with self._lock:
+            key = (reason, permission)
+            self.shed[key] = self.shed.get(key, 0) + 1
+
+    def stats(self):
+        stats = {
+            'in_flight': self.in_flight,
+            'max_concurrent': self.max_concurrent,
+            'shed': sum(self.shed.values())
+        }
+        stats.update(self.backend.stats())
+        return stats
+
+
+'''
+init_app(app)
+    creates the app's RateLimiter from its RATE_LIMITS,
+    MAX_CONCURRENT_REQUESTS and RATE_LIMIT_BACKEND settings, which take
+    precedence over the environment variables, and registers the hooks
+    that enforce the concurrency cap
+'''
+
+
+def init_app(app):
+    limiter = RateLimiter(
+        app.config.setdefault('RATE_LIMITS', RATE_LIMITS),
+        app.config.setdefault('MAX_CONCURRENT_REQUESTS',
+                              MAX_CONCURRENT_REQUESTS),
+        app.config.get('RATE_LIMIT_BACKEND'))
+    app.extensions['rate_limiter'] = limiter
+
+    @app.before_request
+    def admit_request():
+        if not limiter.max_concurrent or request.endpoint is None or \
+                request.endpoint in EXEMPT_ENDPOINTS or \
+                request.endpoint in STREAM_ENDPOINTS:
+            return
+        limiter.enter()
+        g.admitted = True
+
+    # runs once a streamed response has been sent completely
+    @app.teardown_request
+    def release_request(error=None):
+        if g.pop('admitted', False):
+            limiter.leave()
+
+    return limiter
+
+
+'''
+check_rate_limit(permission, payload)
+    applies the current app's rate limit to a request authenticated with
+    payload; called by requires_auth
+'''
+
+
+def check_rate_limit(permission, payload):
+    if not has_app_context():
+        return
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is not None and limiter.limits:
+        limiter.check(permission, payload)
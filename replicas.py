@@ -0,0 +1,269 @@
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+from flask import _request_ctx_stack, current_app, g, has_request_context, \
+    request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, exc, orm
+
+from dbpool import configure_engine, engine_options
+
+"""
+Read-replica routing.
+
+Routes decorated with @read_replica run their queries on one of the
+replicas in DATABASE_REPLICA_URLS (comma-separated, picked round-robin);
+all other routes, and every flush, use the primary (DATABASE_URL). A client
+that wrote (identified by the sub claim of its token, or its address) reads
+from the primary for DB_REPLICA_STICKY_SECONDS afterwards, so it sees its
+own writes even if the replicas lag behind. Stickiness is tracked per
+worker process: keep the window above the replicas' usual lag.
+
+Every replica is health-checked with a SELECT 1 at most every
+DB_REPLICA_CHECK_INTERVAL seconds when it is picked. A replica that fails
+the check, or loses its connection during a request, is skipped until a
+later check succeeds; the failed request is retried once on the primary.
+Other errors of a query on a replica are raised as usual. Without a
+healthy replica, reads fail over to the primary.
+"""
+
+DATABASE_REPLICA_URLS = os.environ.get('DATABASE_REPLICA_URLS', '')
+DB_REPLICA_STICKY_SECONDS = float(
+    os.environ.get('DB_REPLICA_STICKY_SECONDS', 5))
+DB_REPLICA_CHECK_INTERVAL = float(
+    os.environ.get('DB_REPLICA_CHECK_INTERVAL', 10))
+# sticky clients above which expired ones are dropped on the next write
+MAX_STICKY_CLIENTS = 10000
+
+
+'''
+Replica
+    the engine of one replica and its health
+'''
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.engine = create_engine(url, **engine_options(url))
+        configure_engine(self.engine)
+        self.healthy = True
+        self.checked_at = None
+        self.reads = 0
+
+    '''
+    check()
+        runs a SELECT 1 on the replica and records whether it succeeded
+    '''
+    def check(self):
+        try:
+            with self.engine.connect() as connection:
+                connection.scalar('SELECT 1')
+            self.healthy = True
+        except exc.DBAPIError:
+            self.healthy = False
+        self.checked_at = time.monotonic()
+        return self.healthy
+
+    def mark_down(self):
+        self.healthy = False
+        self.checked_at = time.monotonic()
+
+
+'''
+ReplicaSet
+    the replicas of an app, and the clients that have to read from the
+    primary because they wrote recently
+'''
+
+
+class ReplicaSet:
+    def __init__(self, urls, sticky_seconds=None, check_interval=None):
+        self.replicas = [Replica(url) for url in urls]
+        self.sticky_seconds = (DB_REPLICA_STICKY_SECONDS
+                               if sticky_seconds is None else sticky_seconds)
+        self.check_interval = (DB_REPLICA_CHECK_INTERVAL
+                               if check_interval is None else check_interval)
+        self.primary_reads = 0
+        self.failovers = 0
+        self._sticky = {}
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    '''
+    choose()
+        the next healthy replica, checking its health first if the last
+        check is older than the check interval, or None if there is none
+    '''
+    def choose(self):
+        if not self.replicas:
+            return None
+        start = next(self._next)
+        now = time.monotonic()
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if replica.checked_at is None or \
+                    now - replica.checked_at >= self.check_interval:
+                replica.check()
+            if replica.healthy:
+                return replica
+        return None
+
+    '''
+    record_write(client)
+        makes the client read from the primary for the sticky window
+    '''
+    def record_write(self, client):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._sticky) >= MAX_STICKY_CLIENTS:
+                self._sticky = {key: until for key, until
+                                in self._sticky.items() if until > now}
+            self._sticky[client] = now + self.sticky_seconds
+
+    def is_sticky(self, client):
+        until = self._sticky.get(client)
+        return until is not None and until > time.monotonic()
+
+    def stats(self):
+        return {
+            'replicas': len(self.replicas),
+            'healthy': sum(replica.healthy for replica in self.replicas),
+            'replica_reads': sum(replica.reads for replica in self.replicas),
+            'primary_reads': self.primary_reads,
+            'failovers': self.failovers,
+            'sticky_clients': len(self._sticky)
+        }
+
+
+'''
+init_app(app)
+    creates the app's ReplicaSet from its DATABASE_REPLICA_URLS setting,
+    which takes precedence over the environment variable
+'''
+
+
+def init_app(app):
+    urls = app.config.setdefault('DATABASE_REPLICA_URLS',
+                                 DATABASE_REPLICA_URLS)
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+    app.extensions['replicas'] = ReplicaSet(
+        urls, app.config.get('DB_REPLICA_STICKY_SECONDS'),
+        app.config.get('DB_REPLICA_CHECK_INTERVAL'))
+    return app.extensions['replicas']
+
+
+def get_replica_set(app=None):
+    return (app or current_app).extensions.get('replicas')
+
+
+'''
+client_key()
+    identifies the client of the current request: the sub claim of its
+    token (set by requires_auth), or its address
+'''
+
+
+def client_key():
+    payload = getattr(_request_ctx_stack.top, 'current_user', None)
+    if payload and payload.get('sub'):
+        return 'sub:' + payload['sub']
+    return 'addr:' + str(request.remote_addr)
+
+
+'''
+record_write()
+    to be called after every committed write made during a request
+'''
+
+
+def record_write():
+    if not has_request_context():
+        return
+    replica_set = get_replica_set()
+    if replica_set is not None and replica_set.replicas:
+        replica_set.record_write(client_key())
+
+
+'''
+current_replica(replica_set)
+    the replica the current request reads from, or None for the primary;
+    decided on the first query of a @read_replica request
+'''
+
+
+def current_replica(replica_set):
+    if not has_request_context() or not g.get('read_replica'):
+        return None
+    if 'db_replica' not in g:
+        replica = None
+        if not replica_set.is_sticky(client_key()):
+            replica = replica_set.choose()
+        if replica is None:
+            replica_set.primary_reads += 1
+        else:
+            replica.reads += 1
+        g.db_replica = replica
+    return g.db_replica
+
+
+'''
+@read_replica
+    decorator for read-only routes, whose queries may run on a replica. If
+    the connection to the replica is lost during the request, it is
+    retried on the primary.
+    It goes below @requires_auth, so the retry doesn't verify the token or
+    count against the rate limit again.
+'''
+
+
+def read_replica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.read_replica = True
+        try:
+            return f(*args, **kwargs)
+        except (exc.DBAPIError, exc.DisconnectionError) as e:
+            # only a lost connection fails over; other errors (e.g. a
+            # statement timeout or a serialization failure) are the query's
+            if isinstance(e, exc.DBAPIError) and \
+                    not e.connection_invalidated:
+                raise
+            replica = g.pop('db_replica', None)
+            if replica is None:
+                raise
+            replica.mark_down()
+            replica_set = get_replica_set()
+            replica_set.failovers += 1
+            replica_set.primary_reads += 1
+            g.pop('resource_versions', None)
+            current_app.extensions['sqlalchemy'].db.session.rollback()
+            g.read_replica = False
+            return f(*args, **kwargs)
+    return wrapper
+
+
+'''
+RoutingSession
+    a session that runs the queries of @read_replica requests on their
+    replica and everything else, including flushes, on the primary
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replica_set = get_replica_set(self.app)
+        if replica_set is not None and replica_set.replicas and \
+                not self._flushing:
+            replica = current_replica(replica_set)
+            if replica is not None:
+                return replica.engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,146 @@
+import re
+import threading
+from sqlalchemy import func
+
+from models import db, TableVersion
+
+"""
+Ranked substring search over actor names and movie titles.
+
+On PostgreSQL, a search is a single query: ILIKE '%q%' served by the
+pg_trgm GIN indexes created by the migrations, ordered by the trigram
+similarity of the match to the query. Other databases (i.e. SQLite in test
+runs) use an in-process trigram index per resource instead, which is
+rebuilt whenever the resource's version changes and ranks the same way.
+"""
+
+MAX_QUERY_LENGTH = 100
+
+WORD = re.compile(r'[^\W_]+')
+
+'''
+trigrams(text)
+    the set of trigrams of a text, computed like pg_trgm does: lowercased
+    words, each padded with two spaces in front and one behind
+'''
+
+
+def trigrams(text):
+    found = set()
+    for word in WORD.findall(text.lower()):
+        word = f'  {word} '
+        found.update(word[i:i + 3] for i in range(len(word) - 2))
+    return found
+
+
+'''
+similarity(a, b)
+    the share of trigrams that two trigram sets have in common, as
+    pg_trgm's similarity()
+'''
+
+
+def similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+
+
+'''
+TrigramIndex
+    an in-process index of one text column: trigram -> ids. Candidates
+    share the query's unpadded trigrams; those that contain the query as a
+    substring are ranked by similarity.
+'''
+
+
+class TrigramIndex:
+    def __init__(self, rows):
+        self.texts = {}
+        self.trigrams = {}
+        self.postings = {}
+        for id, text in rows:
+            if text is None:
+                continue
+            self.texts[id] = text.lower()
+            self.trigrams[id] = trigrams(text)
+            for trigram in self.trigrams[id]:
+                self.postings.setdefault(trigram, set()).add(id)
+
+    def search(self, q):
+        needle = q.lower()
+        # only the trigrams without padding are certain to appear in every
+        # text that contains the query as a substring
+        inner = {t for t in trigrams(q) if not t.startswith(' ')
+                 and not t.endswith(' ')}
+        if inner:
+            candidates = set.intersection(
+                *[self.postings.get(t, set()) for t in inner])
+        else:
+            candidates = self.texts.keys()
+        query_trigrams = trigrams(q)
+        matches = [id for id in candidates if needle in self.texts[id]]
+        return sorted(matches, key=lambda id: (
+            -similarity(self.trigrams[id], query_trigrams), id))
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+'''
+get_index(model)
+    the in-process index of the model's SEARCH_FIELD, rebuilt if the table
+    was written to since it was built
+'''
+
+
+def get_index(model):
+    resource = model.__tablename__
+    version = TableVersion.current(resource)
+    with _lock:
+        cached = _indexes.get(resource)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    column = getattr(model, model.SEARCH_FIELD)
+    index = TrigramIndex(db.session.query(model.id, column))
+    with _lock:
+        _indexes[resource] = (version, index)
+    return index
+
+
+'''
+search(model, q, columns, limit, offset)
+    the rows (of the given columns, or models if columns is None) whose
+    SEARCH_FIELD contains q, case-insensitively, best matches first
+'''
+
+
+def search(model, q, columns, limit, offset):
+    if db.engine.dialect.name == 'postgresql':
+        return search_query(model, q, columns) \
+            .offset(offset).limit(limit).all()
+    ids = get_index(model).search(q)[offset:offset + limit]
+    if not ids:
+        return []
+    query = db.session.query(*columns) if columns else model.query
+    rows = {row.id: row for row in query.filter(model.id.in_(ids))}
+    return [rows[id] for id in ids if id in rows]
+
+
+'''
+search_query(model, q, columns)
+    the query of a search on PostgreSQL
+'''
+
+
+def search_query(model, q, columns):
+    column = getattr(model, model.SEARCH_FIELD)
+    query = db.session.query(*columns) if columns else model.query
+    return query \
+        .filter(column.ilike(f'%{escape_like(q)}%', escape='\\')) \
+        .order_by(func.similarity(column, q).desc(), model.id)
@@ -0,0 +1,370 @@
+import csv
+import io
+import json
+import os
+import sys
+from sqlalchemy import bindparam, text
+
+from models import (
+    db, Stats, chunks, commit_write, format_value, record_change
+)
+
+"""
+Bulk import and export of actors and movies (see the import and export
+commands of manage.py).
+
+Files are CSV (with a header row) or NDJSON (one JSON object per line),
+with the same fields as the API's items; ids are ignored on import. Items
+are read, validated and written in chunks of IMPORT_CHUNK_SIZE, so memory
+use does not grow with the size of the file.
+
+On PostgreSQL, every chunk is sent into a temporary staging table with
+COPY, and the staging table is merged into the model's table with a single
+INSERT ... ON CONFLICT statement. Elsewhere (SQLite), every chunk is merged
+with one multi-row INSERT and UPDATE per chunk, and the names/titles merged
+so far are kept in a temporary table rather than in memory. In both cases
+rows are applied as if one after the other: with on_conflict "update", a
+row whose name/title exists replaces its other fields (the last of several
+rows with the same name/title wins); with "skip" it is left alone (the
+first wins); with "error" the import fails. An import is a single
+transaction, which also rebuilds the Stats, bumps the table's version and
+sends a single "reload" event to the change feed (see changes.py).
+"""
+
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 10000))
+ON_CONFLICT = ('update', 'skip', 'error')
+FORMATS = ('csv', 'ndjson')
+
+
+'''
+file_format(path, fmt)
+    the format of a file: fmt if given, or else derived from the path's
+    extension (.csv, .ndjson or .jsonl)
+'''
+
+
+def file_format(path, fmt=None):
+    if fmt is None:
+        extension = os.path.splitext(path)[1].lower()
+        fmt = {'.csv': 'csv', '.ndjson': 'ndjson',
+               '.jsonl': 'ndjson'}.get(extension)
+    if fmt not in FORMATS:
+        raise ValueError(f'unknown format of {path}, use --format')
+    return fmt
+
+
+def open_file(path, mode):
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return open(stream.fileno(), mode, newline='', encoding='utf-8',
+                    closefd=False)
+    return open(path, mode, newline='', encoding='utf-8')
+
+
+'''
+read_items(f, fmt)
+    generator of (line number, item) pairs read from a CSV or NDJSON file
+    empty CSV fields are left out of the items; an NDJSON line that isn't
+    valid JSON yields None as its item
+'''
+
+
+def read_items(f, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, {key: value for key, value in row.items()
+                                    if key and value != ''}
+        return
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+
+'''
+ImportResult
+    the counts of an import: items read, rows inserted and updated, valid
+    items not written (conflicts skipped, or superseded by a later item
+    with the same name/title), and invalid items with the first errors
+'''
+
+
+class ImportResult:
+    MAX_ERRORS = 10
+
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.errors = []
+
+    def add_error(self, line_number, message):
+        self.invalid += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append(f'line {line_number}: {message}')
+
+    def stats(self):
+        return {
+            'read': self.read,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'invalid': self.invalid
+        }
+
+
+'''
+import_items(model, items, validate, on_conflict, chunk_size, progress)
+    validates the (line number, item) pairs with validate (see app.py) and
+    merges the valid ones into the model's table, then commits
+    progress(result) is called after every chunk
+    returns an ImportResult; raises IntegrityError with on_conflict "error"
+'''
+
+
+def import_items(model, items, validate, on_conflict='update',
+                 chunk_size=None, progress=None):
+    if on_conflict not in ON_CONFLICT:
+        raise ValueError(f'on_conflict must be one of {ON_CONFLICT}')
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    postgres = db.engine.dialect.name == 'postgresql'
+    result = ImportResult()
+    try:
+        if postgres:
+            create_staging_table(model)
+        else:
+            create_merged_table(model)
+        chunk = []
+        for line_number, item in items:
+            result.read += 1
+            try:
+                chunk.append(validate(item))
+            except ValueError as e:
+                result.add_error(line_number, str(e))
+            if len(chunk) >= chunk_size:
+                write_chunk(model, chunk, on_conflict, postgres, result)
+                chunk = []
+                if progress:
+                    progress(result)
+        if chunk:
+            write_chunk(model, chunk, on_conflict, postgres, result)
+        if postgres:
+            merge_staging_table(model, on_conflict, result)
+        else:
+            db.session.execute(text(f'DROP TABLE {merged_table(model)}'))
+        # cheaper than recording the change of every row
+        db.session.query(Stats).delete()
+        Stats.apply(Stats.compute())
+        # likewise, subscribers of the change feed reload the collection
+        record_change(model.STATS_RESOURCE, 'reload', [])
+    except Exception:
+        db.session.rollback()
+        raise
+    commit_write(model.__tablename__)
+    if progress:
+        progress(result)
+    return result
+
+
+def write_chunk(model, rows, on_conflict, postgres, result):
+    if postgres:
+        copy_to_staging_table(model, rows)
+    else:
+        merge_chunk(model, rows, on_conflict, result)
+
+
+def staging_table(model):
+    return f'"import_{model.__tablename__}"'
+
+
+def import_fields(model):
+    return [field for field in model.FIELDS if field != 'id']
+
+
+def merged_table(model):
+    return f'temp."merged_{model.__tablename__}"'
+
+
+'''
+create_merged_table(model)
+    a temporary table (SQLite) for the names/titles merged by the chunks
+    of an import so far, so that they don't have to be kept in memory;
+    one left behind by a failed import is replaced
+'''
+
+
+def create_merged_table(model):
+    key = model.UNIQUE_FIELD
+    db.session.execute(text(f'DROP TABLE IF EXISTS {merged_table(model)}'))
+    db.session.execute(text(
+        f'CREATE TEMPORARY TABLE {merged_table(model)} '
+        f'({key} {model.__table__.c[key].type.compile(db.engine.dialect)} '
+        'PRIMARY KEY)'))
+
+
+'''
+create_staging_table(model)
+    a temporary table for the imported rows of the model, in the order of
+    the file (seq), dropped at the end of the transaction
+'''
+
+
+def create_staging_table(model):
+    dialect = db.engine.dialect
+    columns = ', '.join(
+        f'{field} {model.__table__.c[field].type.compile(dialect=dialect)}'
+        for field in import_fields(model))
+    db.session.execute(text(
+        f'CREATE TEMPORARY TABLE {staging_table(model)} '
+        f'(seq bigserial, {columns}) ON COMMIT DROP'))
+
+
+def copy_to_staging_table(model, rows):
+    fields = import_fields(model)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([format_value(row[field]) for field in fields])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(f'COPY {staging_table(model)} ({", ".join(fields)}) '
+                       f'FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+'''
+merge_staging_table(model, on_conflict, result)
+    inserts the staged rows into the model's table with one INSERT ...
+    ON CONFLICT statement, keeping one row per name/title (the last one to
+    update, the first one to skip), and counts the inserted and updated rows
+'''
+
+
+def merge_staging_table(model, on_conflict, result):
+    key = model.UNIQUE_FIELD
+    fields = import_fields(model)
+    columns = ', '.join(fields)
+    table = f'"{model.__tablename__}"'
+    if on_conflict == 'error':
+        source = f'SELECT {columns} FROM {staging_table(model)} ORDER BY seq'
+        conflict = ''
+    else:
+        order = 'DESC' if on_conflict == 'update' else 'ASC'
+        source = (f'SELECT DISTINCT ON ({key}) {columns} '
+                  f'FROM {staging_table(model)} ORDER BY {key}, seq {order}')
+        updates = ', '.join(f'{field} = EXCLUDED.{field}'
+                            for field in fields if field != key)
+        conflict = (f'ON CONFLICT ({key}) DO UPDATE SET {updates}'
+                    if on_conflict == 'update'
+                    else f'ON CONFLICT ({key}) DO NOTHING')
+    # xmax is 0 in rows that were inserted rather than updated
+    inserted, updated = db.session.execute(text(
+        f'WITH merged AS (INSERT INTO {table} ({columns}) {source} '
+        f'{conflict} RETURNING (xmax = 0) AS inserted) '
+        f'SELECT count(*) FILTER (WHERE inserted), '
+        f'count(*) FILTER (WHERE NOT inserted) FROM merged')).first()
+    result.inserted += inserted
+    result.updated += updated
+    result.skipped = result.read - result.invalid - result.inserted - \
+        result.updated
+
+
+'''
+merge_chunk(model, rows, on_conflict, result)
+    merges one chunk of rows: one IN (...) query per BULK_CHUNK_SIZE rows
+    finds the existing ones, then one multi-row INSERT and UPDATE write them
+    rows whose name/title an earlier chunk merged (see create_merged_table)
+    count as superseded (skipped) rather than updated, as in
+    merge_staging_table, so the counts don't depend on the chunk size
+'''
+
+
+def merge_chunk(model, rows, on_conflict, result):
+    key = model.UNIQUE_FIELD
+    table = model.__table__
+    if on_conflict == 'error':
+        db.session.execute(table.insert(), rows)
+        result.inserted += len(rows)
+        return
+    unique = {}
+    for row in rows:
+        if on_conflict == 'update' or row[key] not in unique:
+            unique[row[key]] = row
+    result.skipped += len(rows) - len(unique)
+    # the existing names, and whether an earlier chunk merged them;
+    # compiled once, unlike an IN (...) of BULK_CHUNK_SIZE parameters
+    lookup = text(
+        f'SELECT {key}, {key} IN (SELECT {key} FROM {merged_table(model)}) '
+        f'FROM "{model.__tablename__}" WHERE {key} IN :values') \
+        .bindparams(bindparam('values', expanding=True))
+    existing = set()
+    superseded = set()
+    for chunk in chunks(list(unique)):
+        for value, merged in db.session.execute(lookup, {'values': chunk}):
+            (superseded if merged else existing).add(value)
+    result.skipped += len(superseded)
+    inserts = [row for value, row in unique.items()
+               if value not in existing and value not in superseded]
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    result.inserted += len(inserts)
+    new_keys = [{key: value} for value in unique if value not in superseded]
+    if new_keys:
+        db.session.execute(text(
+            f'INSERT INTO {merged_table(model)} ({key}) VALUES (:{key})'),
+            new_keys)
+    if on_conflict == 'skip':
+        result.skipped += len(existing)
+        return
+    result.updated += len(existing)
+    existing.update(superseded)
+    fields = [field for field in import_fields(model) if field != key]
+    statement = table.update() \
+        .where(table.c[key] == bindparam('_' + key)) \
+        .values({field: bindparam(field, type_=table.c[field].type)
+                 for field in fields})
+    for chunk in chunks(list(existing)):
+        db.session.execute(statement, [
+            dict({field: unique[value][field] for field in fields},
+                 **{'_' + key: value}) for value in chunk])
+
+
+'''
+export_items(model, f, fmt, progress)
+    writes every row of the model's table to f as CSV (with a header row)
+    or NDJSON, ordered by id; on PostgreSQL, CSV is written by COPY
+    progress(count) is called after every IMPORT_CHUNK_SIZE rows
+    returns the number of rows written (None for COPY)
+'''
+
+
+def export_items(model, f, fmt, progress=None):
+    if fmt == 'csv' and db.engine.dialect.name == 'postgresql':
+        columns = ', '.join(model.FIELDS)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f'COPY (SELECT {columns} FROM "{model.__tablename__}" '
+            f'ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)', f)
+        return None
+    statement, format_row = model.select_rows(model.FIELDS)
+    statement = statement.execution_options(
+        stream_results=True, max_row_buffer=IMPORT_CHUNK_SIZE)
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, model.FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        def write(item):
+            f.write(json.dumps(item, sort_keys=True) + '\n')
+    count = 0
+    for row in db.session.execute(statement):
+        write(format_row(row))
+        count += 1
+        if progress and count % IMPORT_CHUNK_SIZE == 0:
+            progress(count)
+    return count